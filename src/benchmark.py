@@ -0,0 +1,665 @@
+'''
+Benchmarks for the capture and reduction pipeline.
+
+The acquisition benchmarks run against fake_rtlsdr.FakeRtlSdr, each
+configuration in its own process so the peak RSS is its own.
+
+$ python benchmark.py compression --rows 64 --n 262144
+$ python benchmark.py acquisition --rows 100 --n 131072
+$ python benchmark.py reduce --rows 500 --n 262144
+$ python benchmark.py plot --groups 4 --n 262144
+$ python benchmark.py precision --rows 64 --n 262144
+$ python benchmark.py fft --rows 64 --n 262144 --workers 4
+$ python benchmark.py pfb --rows 64 --n 262144
+$ python benchmark.py rfi --rows 64 --n 262144
+$ python benchmark.py faults --rows 100 --n 16384
+'''
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+import logging
+import os
+import resource
+import sys
+import numpy as np
+from numpy import ndarray
+from scipy.signal import welch, get_window
+import h5py
+
+from compression import CODECS, codec
+import dsp
+import fake_rtlsdr
+import rawcapture
+
+
+logging.basicConfig(level=logging.INFO)
+LOGGER = logging.getLogger(__name__)
+
+
+def noise_iq(rows: int, width: int, sigma: float = 8., seed: int = 0) -> ndarray:
+    '''Interleaved uint8 IQ of gaussian noise, sigma in ADC counts. '''
+    rng = np.random.default_rng(seed)
+    iq = rng.normal(127.5, sigma, (rows, 2 * width)).round()
+    return iq.clip(0, 255).astype(np.uint8)
+
+
+def bench_compression(rows: int, width: int, sample_rate: float,
+                      codecs: list[str], raw: bool = True):
+    '''
+    Write and read noise-like IQ row by row (as collect does) with each codec.
+
+    Reports input MB/s, compression ratio and whether the write rate keeps
+    up with two channels at sample_rate.
+    '''
+    data = noise_iq(rows, width)
+    if not raw:
+        data = (data.astype(np.float64).view(np.complex128) - 127.5 * (1 + 1j)) / 127.5
+    required = 2 * sample_rate * data.itemsize * data.shape[1] / width / 1e6
+    print(f'{rows} rows x {width} samples {data.dtype}, '
+          f'{data.nbytes / 1e6:.1f} MB, required {required:.1f} MB/s for 2 channels')
+    print(f'{"codec":>16} {"write MB/s":>11} {"read MB/s":>10} {"ratio":>7}  keeps up')
+    with TemporaryDirectory() as tmp:
+        for name in codecs:
+            try:
+                kwargs = codec(name)
+            except ImportError as e:
+                LOGGER.warning(e)
+                continue
+            fname = Path(tmp) / f'{name}.h5'
+            start = perf_counter()
+            with h5py.File(fname, 'w') as f:
+                ds = f.create_dataset('IQ', shape=data.shape, chunks=(1, data.shape[1]),
+                                      dtype=data.dtype, **kwargs)
+                for i, row in enumerate(data):
+                    ds[i] = row
+            write = data.nbytes / (perf_counter() - start) / 1e6
+            # no chunk cache, every row is read back through the filter
+            with h5py.File(fname, 'r', rdcc_nbytes=0) as f:
+                ds = f['IQ']
+                start = perf_counter()
+                for i in range(rows):
+                    ds[i]
+                read = data.nbytes / (perf_counter() - start) / 1e6
+                ratio = data.nbytes / ds.id.get_storage_size()
+            print(f'{name:>16} {write:11.1f} {read:10.1f} {ratio:7.3f}  {write > required}')
+
+
+def peak_rss() -> float:
+    '''Peak resident set size of this process in MB. '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _integrate(stream: bool, raw: bool, rows: int, n: int, super_sample: int,
+               sample_rate: float, fake: dict) -> dict:
+    fake_rtlsdr.install(**fake)
+    import collect
+    logging.getLogger('collect').setLevel(logging.WARNING)
+    sdr = collect.SDR(gain=20, sample_rate=sample_rate, n=n, super_sample=super_sample)
+    sdr.configure()
+    width = n * super_sample
+    if raw:
+        buffer = np.zeros((rows, 2 * width), dtype=np.uint8)
+    else:
+        buffer = np.zeros((rows, width), dtype=np.complex128)
+    start = perf_counter()
+    if stream:
+        sdr.streamN(rows, buffer)
+    else:
+        sdr.integrateN(rows, buffer)
+    elapsed = perf_counter() - start
+    stored = int(buffer.any(axis=1).sum())
+    return {'samples/s': stored * width / elapsed, 'rows lost': rows - stored,
+            'peak RSS MB': peak_rss(), 'bytes written': 0}
+
+
+def _collect(options: dict, rows: int, n: int, super_sample: int,
+             sample_rate: float, fake: dict) -> dict:
+    fake_rtlsdr.install(**fake)
+    import collect
+    logging.getLogger('collect').setLevel(logging.WARNING)
+    genConf = collect.ConfGeneral(0, 0, 0, rows)
+    teleConf = collect.ConfTelescope(216, 540, collect.Load.sky)
+    with TemporaryDirectory() as tmp:
+        fname = Path(tmp) / 'benchmark'
+        start = perf_counter()
+        collect.collect([1420.4e6], [sample_rate], [n], [rows], [super_sample], 20,
+                        genConf, teleConf, fname, **options)
+        elapsed = perf_counter() - start
+        if options.get('memmap'):
+            output = Path(f'{fname}{rawcapture.SUFFIX}')
+            written = sum(path.stat().st_size for path in output.iterdir())
+        else:
+            output = Path(f'{fname}.h5')
+            written = output.stat().st_size
+        with rawcapture.open_capture(output) as f:
+            group = f['data/0']
+            if 'IQ' in group:
+                stored = min(int(np.any(group[name][:] != 0, axis=1).sum())
+                             for name in ('IQ', 'reference'))
+            else:
+                stored = 1 + int(min(group.attrs['spectrometer_rows']))
+    return {'samples/s': 2 * stored * n * super_sample / elapsed, 'rows lost': rows - stored,
+            'peak RSS MB': peak_rss(), 'bytes written': written}
+
+
+def bench_acquisition(rows: int, n: int, super_sample: int, sample_rate: float,
+                      fake: dict):
+    '''
+    SDR.integrateN/streamN (one channel) and collect() (two channels) under
+    the capture configurations, against FakeRtlSdr.
+    '''
+    args = (rows, n, super_sample, sample_rate, fake)
+    configurations = [
+            ('integrateN', _integrate, (False, False)),
+            ('integrateN raw', _integrate, (False, True)),
+            ('streamN', _integrate, (True, False)),
+            ('streamN raw', _integrate, (True, True)),
+            ('collect', _collect, ({},)),
+            ('collect raw', _collect, ({'raw': True},)),
+            ('collect raw lzf', _collect, ({'raw': True, 'compression': 'lzf'},)),
+            ('collect raw pipeline', _collect, ({'raw': True, 'pipeline': True},)),
+            ('collect memmap', _collect, ({'memmap': True},)),
+            ('collect raw ddc 8', _collect, ({'raw': True, 'ddc': 8},)),
+            ('collect raw stream pipeline', _collect,
+             ({'raw': True, 'stream': True, 'pipeline': True},)),
+            ('collect spectrometer', _collect,
+             ({'raw': True, 'stream': True, 'spectrometer': True},)),
+            ]
+    realtime = rows * n * super_sample / sample_rate
+    print(f'{rows} rows x {n * super_sample} samples at {sample_rate} Hz '
+          f'({realtime:.2f} s of sky per channel), {fake=}')
+    print(f'{"configuration":>28} {"samples/s":>12} {"rows lost":>9} {"peak RSS MB":>11} {"bytes written":>13}')
+    for name, target, options in configurations:
+        # a fresh process per configuration, for its own peak RSS
+        with get_context('fork').Pool(1) as pool:
+            result = pool.apply(target, options + args)
+        print(f'{name:>28} {result["samples/s"]:12.4g} {result["rows lost"]:9} '
+              f'{result["peak RSS MB"]:11.1f} {result["bytes written"]:13}')
+
+
+class _StallRows(dict):
+    '''Rows by index, holding up the writing thread once, at row stall. '''
+
+    def __init__(self, dtype, stall: int = -1, seconds: float = 0.):
+        super().__init__()
+        self.dtype = np.dtype(dtype)
+        self.stall = stall
+        self.seconds = seconds
+
+    def __setitem__(self, i: int, row: ndarray):
+        super().__setitem__(i, np.array(row))
+        if i == self.stall:
+            sleep(self.seconds)
+
+
+class _TeeRows:
+    '''Keeps each raw row in raw and passes it on to rows. '''
+
+    def __init__(self, raw: dict, rows):
+        self.raw = raw
+        self.rows = rows
+        self.dtype = rows.dtype
+
+    def __setitem__(self, i: int, row: ndarray):
+        self.raw[i] = np.array(row)
+        self.rows[i] = row
+
+
+def bench_faults(rows: int, n: int, error_rate: float, stall: float = 0.5) -> bool:
+    '''
+    Recovery of the acquisition from faults of FakeRtlSdr.
+
+    SDR.integrateN under simulated USB errors (the device closes on a failed
+    read, as pyrtlsdr does), standalone and pooled: the rows lost and the
+    fraction of the rows after the first failed read which were captured,
+    within 3 * error_rate of all of them. SDR.streamN into DDCRows with the
+    writer stalled for stall seconds, overflowing the ring: every overflow
+    leaves a row invalid and the DDC output of the row after it matches a
+    fresh DDC, no filter history across the lost samples. Returns whether
+    all of it holds.
+    '''
+    fake_rtlsdr.install(error_rate=error_rate, realtime=False)
+    import collect
+    logging.getLogger('collect').setLevel(logging.CRITICAL)
+    logging.getLogger('fake_rtlsdr').setLevel(logging.WARNING)
+    passed = True
+    print(f'{rows} rows x {n} samples, error rate {error_rate}')
+    print(f'{"integrateN":>12} {"rows lost":>9} {"captured after the first error":>31}')
+    for name, pool in (('standalone', None), ('pooled', collect.SDRPool())):
+        sdr = collect.SDR(gain=20, n=n, super_sample=1)
+        sdr.configure(pool)
+        buffer = np.zeros((rows, 2 * n), dtype=np.uint8)
+        valid = np.zeros(rows, dtype=bool)
+        sdr.integrateN(rows, buffer, valid)
+        lost = np.flatnonzero(~valid)
+        after = valid[lost[0] + 1:].mean() if len(lost) and lost[0] < rows - 1 else 1.
+        recovers = after >= 1 - 3 * error_rate and bool(buffer[valid].any(axis=1).all())
+        passed &= recovers
+        print(f'{name:>12} {len(lost):9} {after:31.1%}{"" if recovers else "  FAIL"}')
+        if pool is not None:
+            pool.close()
+
+    fake_rtlsdr.install(error_rate=0., realtime=True)
+    sdr = collect.SDR(gain=20, n=n, super_sample=1)
+    sdr.configure()
+    factor = 8
+    make_ddc = lambda: dsp.DDC(sdr.sample_rate, 100e3, factor)
+    raw = dict()
+    out = _StallRows(np.complex64, stall=rows // 4, seconds=stall)
+    valid = np.zeros(rows, dtype=bool)
+    stats = sdr.streamN(rows, _TeeRows(raw, collect.DDCRows(make_ddc(), out, raw=True)),
+                        valid, slots=4)
+    restarts = [i for i in range(1, rows) if valid[i] and not valid[i - 1]]
+    # the oscillator runs on, a restarted row matches a fresh DDC up to its phase
+    fresh = [np.allclose(np.abs(out[i]), np.abs(make_ddc()(collect.bytes_to_iq(raw[i], np.complex64))),
+                         rtol=1e-3, atol=1e-6) for i in restarts]
+    recovers = stats.overflows > 0 and len(restarts) > 0 and all(fresh)
+    passed &= recovers
+    print(f'streamN into DDCRows, writer stalled {stall} s at row {rows // 4}: '
+          f'{stats.overflows} overflows, rows lost {rows - valid.sum()}, '
+          f'{sum(fresh)}/{len(restarts)} rows after a gap restart the DDC'
+          f'{"" if recovers else "  FAIL"}')
+    return passed
+
+
+def welch_rows(data: ndarray, nperseg: int, nfft: int, window: str = dsp.WINDOW) -> ndarray:
+    '''The per row Welch loop reduce.py used before dsp.psd_sum, for comparison. '''
+    Pxx_total = np.zeros(nfft)
+    for iq in data:
+        iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
+        _, p_xx = welch(iq, nperseg=nperseg, nfft=nfft, noverlap=0, scaling='spectrum',
+                        window=window, detrend=False, return_onesided=False)
+        Pxx_total += p_xx
+    return Pxx_total
+
+
+def bench_reduce(rows: int, width: int, block: int = 25):
+    '''
+    Integrated spectrum of a rows x width group, per row Welch loop against
+    the batched dsp.psd_sum. The group is generated and reduced block rows at
+    a time so it need not fit in memory.
+    '''
+    nperseg = dsp.nperseg()
+    timings = {'welch loop': 0., 'dsp.psd_sum': 0.}
+    totals = {name: np.zeros(dsp.NBINS) for name in timings}
+    for i in range(0, rows, block):
+        data = noise_iq(min(block, rows - i), width, seed=i)
+        data = (data.astype(np.float32).view(np.complex64) - 127.5 * (1 + 1j)) / 127.5
+        for name, fn in (('welch loop', welch_rows), ('dsp.psd_sum', dsp.psd_sum)):
+            start = perf_counter()
+            totals[name] += fn(data, nperseg, dsp.NBINS)
+            timings[name] += perf_counter() - start
+    db = {name: 10 * np.log10(total / rows) for name, total in totals.items()}
+    print(f'{rows} rows x {width} samples, nperseg {nperseg}, nfft {dsp.NBINS}')
+    for name, elapsed in timings.items():
+        print(f'{name:>12} {elapsed:8.2f} s {rows * width / elapsed:12.4g} samples/s')
+    print(f'speedup {timings["welch loop"] / timings["dsp.psd_sum"]:.2f}x, '
+          f'max difference {np.abs(db["welch loop"] - db["dsp.psd_sum"]).max():.3g} dB')
+
+
+def bench_plot(groups: int, width: int, rows: int = 4):
+    '''
+    Render the reduce.py plots of groups groups of rows x width noise, each
+    figure new with every point drawn, against headless reused figures with
+    min/max envelope lines.
+    '''
+    import reduce
+    logging.getLogger('reduce').setLevel(logging.WARNING)
+    data = noise_iq(2 * rows, width)
+    data = (data.astype(np.float32).view(np.complex64) - 127.5 * (1 + 1j)) / 127.5
+    chunk = reduce.Chunk(data[:rows], data[rows:])
+    meta = {'sample_rate': 2.4e6, 'frequency': 1420.4e6}
+    products = dict()
+    for name, reducer in reduce.REDUCERS.items():
+        params = {**reducer.params, 'decimation': 100} if name == 'differential' else reducer.params
+        accumulator = reducer.accumulator(meta, **params)
+        accumulator.update(chunk)
+        products[name] = accumulator.finish()
+
+    reduce.headless()
+    print(f'{groups} groups of {rows} rows x {width} samples, {len(products)} plots per group')
+    timings = dict()
+    with TemporaryDirectory() as tmp:
+        for mode, reuse in (('new figures, all points', False),
+                            ('reused figures, envelope', True)):
+            reduce.HEADLESS = reduce.ENVELOPE = reuse
+            start = perf_counter()
+            for i in range(groups):
+                for name, reducer in reduce.REDUCERS.items():
+                    reducer.plot(products[name], False, Path(tmp) / f'{i}-{reducer.suffix}')
+            timings[mode] = perf_counter() - start
+            print(f'{mode:>26} {timings[mode]:8.2f} s {timings[mode] / groups:8.2f} s/group')
+    print(f'speedup {timings["new figures, all points"] / timings["reused figures, envelope"]:.2f}x')
+
+
+PRECISION_BOUND = 1e-5  # largest single precision error, relative to the product's peak
+
+
+def bench_pfb(rows: int, width: int, taps: int = dsp.PFB_TAPS, block: int = 16):
+    '''
+    Spectrum engines on the same frequency axis (dsp.NBINS channels), the
+    Welch path (dsp.psd_sum, dsp.N_SEG_LIM segments zero padded) against the
+    polyphase filterbank (dsp.pfb_sum): throughput over rows x width noise,
+    calibration of the noise density and the leakage of a tone into the
+    channels around it, the worst case over tone offsets of 0 to 7/16 of a
+    channel from the centre of channel k (a tone exactly at a centre lands on
+    the nulls of the Welch window and understates its leakage).
+    '''
+    sample_rate = 2.4e6
+    nperseg = dsp.nperseg()
+    nbins = dsp.NBINS
+    engines = {'welch': (lambda x: dsp.psd_sum(x, nperseg, nbins),
+                         lambda P: dsp.density(P, sample_rate, nperseg)),
+               'pfb': (lambda x: dsp.pfb_sum(x, nbins, taps),
+                       lambda P: dsp.pfb_density(P, sample_rate, nbins, taps))}
+    timings = {name: 0. for name in engines}
+    totals = {name: np.zeros(nbins) for name in engines}
+    for i in range(0, rows, block):
+        data = noise_iq(min(block, rows - i), width, seed=i)
+        data = (data.astype(np.float32).view(np.complex64) - 127.5 * (1 + 1j)) / 127.5
+        for name, (engine, _) in engines.items():
+            start = perf_counter()
+            totals[name] += engine(data)
+            timings[name] += perf_counter() - start
+
+    # tones between the centres of channels k and k + 1, no noise
+    k = nbins // 8
+    t = np.arange(width) / sample_rate
+    fractions = np.arange(8) / 16
+    tones = np.exp(2j * np.pi * (k + fractions[:, np.newaxis]) * sample_rate / nbins * t)
+    offsets = np.array([1, 2, 4, 8, 16, 64])
+    print(f'{rows} rows x {width} samples, {nbins} channels, welch nperseg {nperseg}, pfb {taps} taps')
+    print(f'{"engine":>8} {"time s":>8} {"samples/s":>12} {"noise dB/Hz":>12} '
+          + ' '.join(f'{f"+{offset} ch dB":>10}' for offset in offsets))
+    for name, (engine, density) in engines.items():
+        noise = 10 * np.log10(density(totals[name] / rows).mean())
+        # worst case over the tone offsets, relative to the peak channel of each tone
+        responses = np.array([engine(tone[np.newaxis]) for tone in tones])
+        responses /= responses.max(axis=1, keepdims=True)
+        leakage = np.maximum(responses[:, k + offsets], responses[:, k - offsets]).max(axis=0)
+        leakage = 10 * np.log10(np.maximum(leakage, 1e-30))
+        print(f'{name:>8} {timings[name]:8.2f} {rows * width / timings[name]:12.4g} '
+              f'{noise:12.3f} ' + ' '.join(f'{level:10.1f}' for level in leakage))
+    print(f'pfb time / welch time {timings["pfb"] / timings["welch"]:.2f}')
+
+
+def bench_rfi(rows: int, width: int, sample_rate: float, seed: int = 0):
+    '''
+    Online RFI flagging (dsp.Spectrometer.flagged_psd) against the plain
+    psd() of each complex64 row: throughput against the three spectra per row pair of
+    SpectrometerWriter (signal, reference and corrected) at sample_rate, the
+    false flag rate on noise, and over the same noise with an intermittent
+    tone (on for the first quarter of odd rows) and a broadband burst (1 ms
+    in every eighth row), the flagged fraction of the injected cells and the
+    excess of the integrated spectrum at the tone with and without flagging.
+    '''
+    spectrometer = dsp.Spectrometer()
+    nbins = spectrometer.nbins
+    k = nbins // 8  # tone channel
+    t = np.arange(width) / sample_rate
+    tone = 0.1 * np.exp(2j * np.pi * k * sample_rate / nbins * t)
+    tone[width // 4:] = 0
+    burst = np.zeros(width)
+    burst[:int(1e-3 * sample_rate)] = 1.
+    timings = {'psd': 0., 'flagged': 0.}
+    flags = {'clean': [], 'rfi': []}
+    totals = {'psd': np.zeros(nbins), 'flagged': dsp.Spectrometer()}
+    for i in range(rows):
+        # complex64, as SpectrometerWriter unpacks the raw rows
+        row = noise_iq(1, width, seed=seed + i)[0].astype(np.float32).view(np.complex64)
+        row = (row - np.complex64(127.5 * (1 + 1j))) / np.float32(127.5)
+        start = perf_counter()
+        spectrometer.psd(row)
+        timings['psd'] += perf_counter() - start
+        start = perf_counter()
+        flags['clean'].append(spectrometer.flagged_psd(row)[1])
+        timings['flagged'] += perf_counter() - start
+
+        row += tone * (i % 2) + burst * (i % 8 == 0) * np.random.default_rng(i).normal(size=width)
+        P, row_flags = spectrometer.flagged_psd(row)
+        flags['rfi'].append(row_flags)
+        totals['psd'] += P
+        totals['flagged'].add_power(P, flags=row_flags)
+    clean = np.array(flags['clean'])
+    rfi = np.array(flags['rfi'])
+    # SpectrometerWriter.add flags signal, reference and corrected per row pair
+    required = 3 * sample_rate
+    print(f'{rows} rows x {width} samples, {nbins} channels, '
+          f'required {required:.4g} samples/s for the 3 spectra of 2 channels')
+    print(f'{"":>8} {"time s":>8} {"samples/s":>12}  keeps up')
+    for name, elapsed in timings.items():
+        rate = rows * width / elapsed
+        print(f'{name:>8} {elapsed:8.2f} {rate:12.4g}  {"yes" if rate >= required else "NO"}')
+    print(f'flagging overhead {timings["flagged"] / timings["psd"] - 1:.1%}')
+    print(f'false flags on noise {clean.mean():.2e} of the cells')
+    quiet = np.arange(rows) % 8 > 0
+    print(f'intermittent tone flagged in {rfi[1::2, k].mean():.0%} of its rows, '
+          f'{rfi[0::2, k][quiet[0::2]].mean():.0%} of the quiet rows without it')
+    print(f'broadband burst flagged in {rfi[0::8].mean():.0%} of the channels of its rows, '
+          f'{rfi[quiet].mean():.2e} of the cells of the other rows')
+    for name, P in (('psd', totals['psd'] / rows), ('flagged', totals['flagged'].mean())):
+        excess = 10 * np.log10(P[k] / np.nanmedian(P))
+        print(f'{name:>8} spectrum: tone excess over the median channel {excess:6.2f} dB')
+
+
+def bench_precision(rows: int, width: int, bound: float = PRECISION_BOUND) -> bool:
+    '''
+    Every reduce.py reducer over a raw group of rows x width noise and a
+    tone, in single and double precision: time and the largest difference
+    of each product relative to its peak magnitude in double. Returns
+    whether all of them are within bound.
+    '''
+    import reduce
+    logging.getLogger('reduce').setLevel(logging.WARNING)
+    sample_rate = 2.4e6
+    t = np.arange(width) / sample_rate
+    tone = 4 * np.exp(2j * np.pi * 100e3 * t)
+    within = True
+    with TemporaryDirectory() as tmp:
+        fname = Path(tmp) / 'precision.h5'
+        with h5py.File(fname, 'w') as file:
+            group = file.create_group('data/0')
+            group.attrs.update({'sample_rate': sample_rate, 'frequency': 1420.4e6})
+            for seed, name in enumerate(('IQ', 'reference')):
+                data = noise_iq(rows, width, seed=seed).astype(np.float64)
+                if name == 'IQ':
+                    data[:, 0::2] += tone.real
+                    data[:, 1::2] += tone.imag
+                dataset = group.create_dataset(name, data=data.round().clip(0, 255).astype(np.uint8),
+                                               chunks=(1, 2 * width))
+                dataset.attrs.update({'encoding': 'uint8-interleaved',
+                                      'dc_offset': 127.5, 'scale': 1 / 127.5})
+
+        products = dict()
+        timings = dict()
+        with h5py.File(fname, 'r') as file:
+            for precision in reduce.PRECISIONS:
+                start = perf_counter()
+                products[precision] = reduce.reduce_group(file['data/0'], list(reduce.REDUCERS),
+                                                          precision=precision)
+                timings[precision] = perf_counter() - start
+
+    print(f'{rows} rows x {width} samples, every reducer in one pass')
+    for precision, elapsed in timings.items():
+        print(f'{precision:>8} {elapsed:8.2f} s {rows * width / elapsed:12.4g} samples/s')
+    print(f'speedup {timings["double"] / timings["single"]:.2f}x')
+    print(f'{"product":>44} {"relative error":>15} (bound {bound:.0e})')
+    for name in reduce.REDUCERS:
+        for key, double in products['double'][name].items():
+            double = np.asarray(double)
+            if not np.issubdtype(double.dtype, np.number):
+                continue
+            if key.endswith(('_mask', '_occupancy')):
+                # RFI flag decisions, not values
+                continue
+            single = np.asarray(products['single'][name][key])
+            if name in ('spectrum', 'rfi') or key.endswith('_spectrum'):
+                # dB, compare the powers
+                double, single = 10**(double / 10), 10**(single / 10)
+            # channels flagged in every row are nan
+            error = np.nanmax(np.abs(single - double)) / max(np.nanmax(np.abs(double)), np.finfo(float).tiny)
+            within &= bool(error <= bound)
+            print(f'{name + "/" + key:>44} {error:15.3g}{"" if error <= bound else "  FAIL"}')
+    return within
+
+
+def bench_fft(rows: int, width: int, workers: int, repeat: int = 3):
+    '''
+    The spectral and ACF engines (dsp.psd_sum, dsp.acf_power_sum) over rows
+    x width complex64 noise on each FFT backend, and the window lookup of
+    every psd() call, get_window against the dsp.window_array cache.
+    '''
+    data = noise_iq(rows, width)
+    data = (data.astype(np.float32).view(np.complex64) - 127.5 * (1 + 1j)) / 127.5
+    nperseg = dsp.nperseg()
+    nfft = dsp.acf_nfft(width, width)
+    engines = {'psd_sum': lambda: dsp.psd_sum(data, nperseg, dsp.NBINS),
+               'acf_power_sum': lambda: dsp.acf_power_sum(data, nfft)}
+    backends = [('numpy', 1), ('scipy', 1)]
+    if workers > 1:
+        backends.append(('scipy', workers))
+    print(f'{rows} rows x {width} samples, psd {nperseg}/{dsp.NBINS} points, '
+          f'acf {nfft} points, best of {repeat}, {os.cpu_count()} CPUs')
+    print(f'{"engine":>14} {"backend":>16} {"time s":>8} {"speedup":>8} {"max rel diff":>13}')
+    for name, engine in engines.items():
+        baseline = reference = None
+        for backend, threads in backends:
+            dsp.fft_backend(backend, threads)
+            elapsed = []
+            for _ in range(repeat):
+                start = perf_counter()
+                result = engine()
+                elapsed.append(perf_counter() - start)
+            best = min(elapsed)
+            if baseline is None:
+                baseline, reference = best, result
+            difference = np.abs(result - reference).max() / np.abs(reference).max()
+            print(f'{name:>14} {f"{backend} x{threads}":>16} {best:8.3f} '
+                  f'{baseline / best:7.2f}x {difference:13.3g}')
+    dsp.fft_backend()
+
+    calls = 10000
+    start = perf_counter()
+    for _ in range(calls):
+        get_window(dsp.WINDOW, nperseg).astype(np.float32)
+    uncached = (perf_counter() - start) / calls
+    start = perf_counter()
+    for _ in range(calls):
+        dsp.window_array(dsp.WINDOW, nperseg, np.float32)
+    cached = (perf_counter() - start) / calls
+    print(f'window lookup: get_window {uncached * 1e6:.1f} us, '
+          f'dsp.window_array {cached * 1e6:.2f} us per psd() call')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_compression = commands.add_parser('compression', help='capture file codecs')
+    parser_compression.add_argument('--rows', default=32, type=int,
+                                    help='rows to write, default 32')
+    parser_compression.add_argument('--n', default=2**18, type=int,
+                                    help='samples per row, default 2**18')
+    parser_compression.add_argument('--sample_rate', default=2.85e6, type=float,
+                                    help='sample rate of each channel, default 2.85e6 Hz')
+    parser_compression.add_argument('--codecs', nargs='+',
+                                    default=['none', 'lzf', 'gzip-1', 'gzip-5',
+                                             'shuffle-lzf', 'bitshuffle-lz4', 'lz4', 'zstd'],
+                                    help=f'codecs to compare, from {CODECS}')
+    parser_compression.add_argument('--complex', default=False, action='store_true',
+                                    help='benchmark complex128 rows instead of raw uint8')
+
+    parser_acquisition = commands.add_parser('acquisition', help='integrateN and collect() throughput')
+    parser_acquisition.add_argument('--rows', default=50, type=int,
+                                    help='rows per channel, default 50')
+    parser_acquisition.add_argument('--n', default=2**16, type=int,
+                                    help='samples per call, default 2**16')
+    parser_acquisition.add_argument('--super_sample', default=2, type=int,
+                                    help='multiplies the sample width, default 2')
+    parser_acquisition.add_argument('--sample_rate', default=2.85e6, type=float,
+                                    help='sample rate, default 2.85e6 Hz')
+    parser_acquisition.add_argument('--error_rate', default=0., type=float,
+                                    help='probability of a simulated USB error per read, default 0')
+    parser_acquisition.add_argument('--no_realtime', default=False, action='store_true',
+                                    help='pass to let the simulated dongles run as fast as possible')
+
+    parser_reduce = commands.add_parser('reduce', help='integrated spectrum engines')
+    parser_reduce.add_argument('--rows', default=500, type=int,
+                               help='rows in the group, default 500')
+    parser_reduce.add_argument('--n', default=2**18, type=int,
+                               help='samples per row, default 2**18')
+
+    parser_plot = commands.add_parser('plot', help='reduce.py plot rendering')
+    parser_plot.add_argument('--groups', default=4, type=int,
+                             help='groups to plot, default 4')
+    parser_plot.add_argument('--n', default=2**18, type=int,
+                             help='samples per row, default 2**18')
+
+    parser_precision = commands.add_parser('precision', help='reduce.py single against double precision')
+    parser_precision.add_argument('--rows', default=64, type=int,
+                                  help='rows in the group, default 64')
+    parser_precision.add_argument('--n', default=2**18, type=int,
+                                  help='samples per row, default 2**18')
+    parser_precision.add_argument('--bound', default=PRECISION_BOUND, type=float,
+                                  help=f'largest relative error of a product, default {PRECISION_BOUND}')
+
+    parser_fft = commands.add_parser('fft', help='FFT backends of the spectral and ACF engines')
+    parser_fft.add_argument('--rows', default=64, type=int,
+                            help='rows transformed, default 64')
+    parser_fft.add_argument('--n', default=2**18, type=int,
+                            help='samples per row, default 2**18')
+    parser_fft.add_argument('--workers', default=os.cpu_count(), type=int,
+                            help=f'scipy.fft threads of the threaded run, default {os.cpu_count()} (CPUs)')
+
+    parser_pfb = commands.add_parser('pfb', help='polyphase filterbank against Welch spectra')
+    parser_pfb.add_argument('--rows', default=64, type=int,
+                            help='rows in the group, default 64')
+    parser_pfb.add_argument('--n', default=2**18, type=int,
+                            help='samples per row, default 2**18')
+    parser_pfb.add_argument('--taps', default=dsp.PFB_TAPS, type=int,
+                            help=f'taps per channel, default {dsp.PFB_TAPS}')
+
+    parser_rfi = commands.add_parser('rfi', help='online RFI flagging cost and detection')
+    parser_rfi.add_argument('--rows', default=64, type=int,
+                            help='rows flagged, default 64')
+    parser_rfi.add_argument('--n', default=2**18, type=int,
+                            help='samples per row, default 2**18')
+    parser_rfi.add_argument('--sample_rate', default=2.85e6, type=float,
+                            help='sample rate of each channel, default 2.85e6 Hz')
+
+    parser_faults = commands.add_parser('faults', help='acquisition recovery from simulated USB errors')
+    parser_faults.add_argument('--rows', default=100, type=int,
+                               help='rows per capture, default 100')
+    parser_faults.add_argument('--n', default=2**14, type=int,
+                               help='samples per row, default 2**14')
+    parser_faults.add_argument('--error_rate', default=0.05, type=float,
+                               help='probability of a simulated USB error per read, default 0.05')
+
+    args = parser.parse_args()
+
+    match args.command:
+        case 'compression':
+            bench_compression(args.rows, args.n, args.sample_rate, args.codecs,
+                              raw=not args.complex)
+        case 'acquisition':
+            bench_acquisition(args.rows, args.n, args.super_sample, args.sample_rate,
+                              {'error_rate': args.error_rate, 'realtime': not args.no_realtime})
+        case 'reduce':
+            bench_reduce(args.rows, args.n)
+        case 'plot':
+            bench_plot(args.groups, args.n)
+        case 'fft':
+            bench_fft(args.rows, args.n, args.workers)
+        case 'pfb':
+            bench_pfb(args.rows, args.n, args.taps)
+        case 'rfi':
+            bench_rfi(args.rows, args.n, args.sample_rate)
+        case 'precision':
+            if not bench_precision(args.rows, args.n, args.bound):
+                sys.exit(1)
+        case 'faults':
+            if not bench_faults(args.rows, args.n, args.error_rate):
+                sys.exit(1)
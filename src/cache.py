@@ -0,0 +1,116 @@
+'''
+Sidecar HDF5 cache of reduction products (reduce.py).
+
+An entry is keyed by a hash of the source file identity (path, size,
+modification time), the group, the reducer, its parameters and the
+precision, so a rerun only re-plots. Entries of a source file which changed
+are dropped and the least recently used entries are evicted over a size
+limit.
+'''
+from pathlib import Path
+from time import time
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from numpy import ndarray
+import h5py
+
+
+LOGGER = logging.getLogger(__name__)
+VERSION = 5  # bump when a reducer's products change, orphans every entry
+MAX_SIZE = 1024  # MB, default size limit of a cache file
+
+
+def identity(fname: Path | str) -> dict:
+    '''Identity of a source file, it changes when the file is rewritten. '''
+    stat = os.stat(fname)
+    return {'path': str(Path(fname).resolve()), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def key(source: dict, group: str, reducer: str, params: dict,
+        rows: None | ndarray = None, precision: str = 'double') -> str:
+    '''Cache key of the products of reducer (with params, at precision) over rows of group. '''
+    if rows is not None:
+        rows = hashlib.sha1(np.asarray(rows, dtype=np.int64).tobytes()).hexdigest()
+    description = {'version': VERSION, 'source': source, 'group': group,
+                   'reducer': reducer, 'params': params, 'rows': rows,
+                   'precision': precision}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ReductionCache:
+    '''
+    Products (dicts of arrays) stored by key() in an HDF5 file.
+
+    Only one process may hold a cache file open, reduce.py keeps it in the
+    parent of the --jobs pool.
+    '''
+
+    def __init__(self, fname: Path | str, max_size: float = MAX_SIZE):
+        self.fname = Path(fname)
+        self.max_size = max_size
+        if self.fname.exists():
+            self.file = h5py.File(self.fname, 'a')
+        else:
+            # persist the free space of evicted entries so it is reused
+            self.file = h5py.File(self.fname, 'w', fs_strategy='fsm', fs_persist=True)
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        LOGGER.info(f'{self.fname}: {self.hits} hits, {self.misses} misses')
+        self.file.close()
+
+    def invalidate(self, source: dict):
+        '''Drop the entries of source['path'] written from another version of it. '''
+        for name, entry in list(self.file.items()):
+            if (entry.attrs['path'] == source['path']
+                    and (entry.attrs['size'], entry.attrs['mtime_ns'])
+                    != (source['size'], source['mtime_ns'])):
+                LOGGER.debug(f'{source["path"]} changed, dropping {name}')
+                del self.file[name]
+
+    def get(self, key: str) -> None | dict:
+        if key not in self.file:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = self.file[key]
+        entry.attrs['accessed'] = time()
+        return {name: dataset[()] for name, dataset in entry.items()}
+
+    def put(self, key: str, products: dict, source: dict):
+        if key in self.file:
+            del self.file[key]
+        entry = self.file.create_group(key)
+        for name, value in products.items():
+            entry.create_dataset(name, data=value)
+        entry.attrs.update(source)
+        entry.attrs['accessed'] = time()
+        self.evict()
+        self.file.flush()
+
+    def size(self, key: str) -> int:
+        '''Bytes stored by an entry. '''
+        return sum(dataset.id.get_storage_size() for dataset in self.file[key].values())
+
+    def evict(self):
+        '''Delete least recently used entries until the cache fits max_size MB. '''
+        entries = sorted(self.file, key=lambda name: self.file[name].attrs['accessed'])
+        sizes = {name: self.size(name) for name in entries}
+        total = sum(sizes.values())
+        for name in entries[:-1]:
+            if total <= self.max_size * 2**20:
+                break
+            LOGGER.debug(f'evicting {name}, {sizes[name]} bytes')
+            total -= sizes[name]
+            del self.file[name]
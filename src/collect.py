@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 from dataclasses import dataclass
 from math import sqrt
 from numpy import ndarray
@@ -10,7 +11,13 @@ import numpy as np
 import h5py
 from itertools import product
 from enum import Enum
+import queue
 import threading
+import time
+
+from compression import DEFAULT_CODEC, CODECS, codec
+import dsp
+import rawcapture
 
 from datetime import datetime, timedelta, timezone
 
@@ -123,8 +130,93 @@ class ConfGeneral:
         return f'{self.datetime.year}{self.datetime.month:02}{self.datetime.day:02}.{self.datetime.hour:02}{self.datetime.minute:02}'
 
 
+@dataclass
+class StreamStats:
+    rows: int = 0           # rows delivered to the caller's buffer
+    received: int = 0       # transfers handed to the callback by librtlsdr
+    overflows: int = 0      # transfers discarded because the ring was full
+    discarded: int = 0      # rows lost to an overflow, their index is skipped
+    dropped: int = 0        # transfers missing from the sample clock timeline
+    elapsed: float = 0      # seconds spanned by the received transfers
+    duty_cycle: float = 0   # fraction of elapsed time that made it into rows
+
+
+# raw IQ: sample = (byte - IQ_DC_OFFSET) * IQ_SCALE
+IQ_DC_OFFSET = 127.5
+IQ_SCALE = 1 / 127.5
+TRANSFER_BYTES = 2**18  # bytes per async transfer, 15 librtlsdr buffers of 2 dongles fit usbfs' 16 MB
+GAP = -1  # streamN ring marker of a transfer lost to an overflow
+PIPELINE_BYTES = 2**27  # rows queued by a PipelineWriter, 16 complex128 rows of 2**19 samples
+HI_FREQUENCY = 1420.4057e6  # Hz, default centre of the --ddc band
+RAW_ATTRS = {'encoding': 'uint8-interleaved', 'dc_offset': IQ_DC_OFFSET, 'scale': IQ_SCALE}
+# downconverted IQ: sample = int16 * DDC_SCALE, 7 bits finer than the ADC to
+# keep the decimation gain, full scale 2
+DDC_SCALE = IQ_SCALE / 2**7
+DDC_ATTRS = {'encoding': 'int16-interleaved', 'dc_offset': 0., 'scale': DDC_SCALE}
+
+
+def bytes_to_iq(raw: ndarray, dtype: type = np.complex128) -> ndarray:
+    '''Unpack interleaved uint8 IQ, same normalization as RtlSdr.packed_bytes_to_iq. '''
+    iq = raw.astype(np.empty(0, dtype=dtype).real.dtype).view(dtype)
+    iq -= IQ_DC_OFFSET * (1 + 1j)
+    iq *= IQ_SCALE
+    return iq
+
+
+class SDRPool:
+    '''
+    RtlSdr handles keyed by serial number.
+
+    Each dongle is opened (USB and tuner init) once, SDR.configure then
+    retunes the pooled handle in place for every step of a sweep. pyrtlsdr
+    closes a handle on a failed read or setter, get() reopens it.
+    '''
+
+    def __init__(self):
+        self.devices: dict[str, RtlSdr] = dict()
+
+    def get(self, serial_number: str) -> RtlSdr:
+        if serial_number in self.devices and not self.devices[serial_number].device_opened:
+            LOGGER.warning(f'{serial_number=} was closed after an error, reopening')
+            del self.devices[serial_number]
+        if serial_number not in self.devices:
+            LOGGER.info(f'initializing RTL-SDR Blog V4 {serial_number=}')
+            self.devices[serial_number] = RtlSdr(serial_number=serial_number)
+        return self.devices[serial_number]
+
+    def close(self):
+        for serial_number, sdr in self.devices.items():
+            sdr.close()
+            LOGGER.info(f'closed SDR RTL V4 Blog {serial_number=}')
+        self.devices.clear()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class SDR(ConfSDR):
-    def configure(self):
+    SETTLE_SAMPLES = 2**16  # samples discarded after retuning
+    MAX_REOPENS = 3         # consecutive lost rows integrateN reopens the device for
+
+    sdr: None | RtlSdr = None
+    pool: None | SDRPool = None
+    pooled: bool = False
+    stream_stats: None | StreamStats = None
+    retune_time: float = 0  # seconds to apply frequency, gain and sample rate
+    settle_time: float = 0  # seconds to read and discard SETTLE_SAMPLES
+
+    def configure(self, pool: None | SDRPool = None):
+        '''
+        Open (or take from pool) the RTL-SDR and apply the configuration.
+
+        Retune and settle latency are logged and kept in retune_time and
+        settle_time. A settle read which closes the device (pyrtlsdr does on
+        a libusb error) reopens and retunes it once, IOError if it fails
+        again.
+        '''
         LOGGER.info(f'configuring RTL-SDR Blog V4 {self.serial_number=}')
         # LOGGER.info(f'\t{self.bandwidth=} Hz')
         LOGGER.info(f'\t{self.center_freq=} Hz')
@@ -133,50 +225,613 @@ class SDR(ConfSDR):
         LOGGER.info(f'\t{self.n=}')
         LOGGER.info(f'\t~{self.frequency_resolution()=} Hz')
         LOGGER.info(f'\t{self.super_sample=}')
-        # if self.sdr is None:
-        LOGGER.info(f'initializing RTL-SDR Blog V4 {self.serial_number=}')
-        self.sdr = RtlSdr(serial_number=self.serial_number)
+        for _ in range(2):
+            self.open(pool)
+            self.tune()
+            # the first samples after a retune are from the previous setting
+            start = time.perf_counter()
+            try:
+                self.sdr.read_bytes(2 * self.SETTLE_SAMPLES)
+            except IOError as e:
+                LOGGER.warning(f'settle read failed: {e}')
+            self.settle_time = time.perf_counter() - start
+            if self.sdr.device_opened:
+                break
+            LOGGER.warning(f'{self.serial_number=} closed by the failed settle read')
+        else:
+            raise IOError(f'{self.serial_number=} closed on every settle read')
+        LOGGER.info(f'{self.serial_number=} {self.retune_time=:.4f} s {self.settle_time=:.4f} s')
 
+    def open(self, pool: None | SDRPool = None):
+        '''Open the RTL-SDR, or take it from pool. '''
+        if pool is None:
+            LOGGER.info(f'initializing RTL-SDR Blog V4 {self.serial_number=}')
+            self.sdr = RtlSdr(serial_number=self.serial_number)
+        else:
+            self.sdr = pool.get(self.serial_number)
+            self.pooled = True
+        self.pool = pool
+
+    def tune(self):
+        '''Apply frequency, gain and sample rate, timed as retune_time. '''
+        start = time.perf_counter()
         # self.sdr.bandwidth = self.bandwidth
         self.sdr.center_freq = self.center_freq
         self.sdr.gain = self.gain
         self.sdr.sample_rate = self.sample_rate
+        self.retune_time = time.perf_counter() - start
         LOGGER.info(f'{self.sdr.get_gain()=}')
         LOGGER.info(f'{self.sdr.get_bandwidth()=}')
         LOGGER.info(f'{self.sdr.get_sample_rate()=}')
 
     def __del__(self):
-        if self.sdr is not None:
+        if self.sdr is not None and not self.pooled:
             self.sdr.close()
             LOGGER.info(f'closed SDR RTL V4 Blog {self.serial_number=}')
 
-    def integrate(self):
+    def integrate(self, raw: bool = False):
+        '''
+        Read one row of n * super_sample IQ samples.
+
+        raw: return the interleaved uint8 IQ as delivered by the device
+             instead of normalized complex samples
+        '''
         if self.sdr is None:
             LOGGER.warning('please configure the SDR')
             return
         N = self.n * self.super_sample
         LOGGER.debug(f'reading {N} samples')
+        if raw:
+            # read_bytes reuses its buffer between calls
+            return np.ctypeslib.as_array(self.sdr.read_bytes(2 * N)).copy()
         return self.sdr.read_samples(num_samples=self.n * self.super_sample)
 
-    def integrateN(self, N: int, buffer: ndarray) -> None:
+    def integrateN(self, N: int, buffer: ndarray, valid: None | ndarray = None,
+                   timestamps: None | ndarray = None,
+                   monotonic: None | ndarray = None) -> None:
+        '''
+        Fill buffer with N rows, row i is written in place as it is read.
+
+        buffer is an ndarray or a RowWriter, a uint8 buffer receives raw
+        interleaved IQ. valid[i] is set if row i was captured (a row lost
+        to an IOError keeps its place, zero filled) and timestamps[i] to
+        the time.time() at which its read returned. monotonic[i] is set to
+        the time.monotonic_ns() at the start and end of the read, both
+        taken before the row is written to buffer.
+
+        pyrtlsdr closes the device on a failed read, it is reopened (from
+        the pool it was configured with) and retuned before the next row.
+        After MAX_REOPENS consecutive lost rows the rest are given up as lost.
+        '''
+        raw = buffer.dtype == np.uint8
         lost_integrations = 0
+        failures = 0  # consecutive lost rows
         if self.sdr is None:
             LOGGER.warning('please configure the SDR')
             return None
         else:
-            data_set = list()
             LOGGER.info(f'starting integration {N} rows')
             for i in range(N):
                 LOGGER.debug(f'row {i}')
                 try:
-                    data_set.append(self.integrate())
+                    read_start = time.monotonic_ns()
+                    row = self.integrate(raw)
+                    # stamped before the write, which may compress or wait on a queue
+                    if monotonic is not None:
+                        monotonic[i] = read_start, time.monotonic_ns()
+                    if timestamps is not None:
+                        timestamps[i] = time.time()
+                    buffer[i] = row
+                    if valid is not None:
+                        valid[i] = True
+                    failures = 0
                 except IOError as e:
                     LOGGER.exception(e)
                     lost_integrations += 1
+                    failures += 1
+                    if failures > self.MAX_REOPENS:
+                        LOGGER.error(f'{self.serial_number=} lost {failures} rows in a row, '
+                                     f'giving up on the last {N - i - 1}')
+                        lost_integrations += N - i - 1
+                        break
+                    if not self.sdr.device_opened:
+                        LOGGER.warning(f'{self.serial_number=} closed at row {i}, reopening')
+                        try:
+                            self.configure(self.pool)
+                        except IOError as e:
+                            LOGGER.exception(e)
             LOGGER.info('complete')
             if lost_integrations > 0:
                 LOGGER.info(f'{lost_integrations} integrations lost')
-            buffer[:] = np.vstack(data_set)
+
+    def streamN(self, N: int, buffer: ndarray, valid: None | ndarray = None,
+                timestamps: None | ndarray = None, monotonic: None | ndarray = None,
+                slots: int = 32) -> None | StreamStats:
+        '''
+        Fill buffer with N rows from a continuous async read.
+
+        The stream is read in fixed transfers of TRANSFER_BYTES (or one row,
+        if shorter), so the librtlsdr buffers stay within the usbfs memory
+        limit whatever the row width. The callback only copies each
+        transfer into a free slot of a pre-allocated ring and returns, while
+        this thread assembles rows from consecutive slots into buffer
+        (copied as is into a uint8 buffer). Transfers arriving while every
+        slot is full are counted as overflows and break the stream, the row
+        across the break is discarded and its index skipped (valid[i] stays
+        False, as for a row integrateN lost). Gaps in the transfer timeline (relative to
+        the sample clock) are counted as dropped. valid, timestamps and
+        monotonic are set as in integrateN, from the callback time of the
+        transfer completing the row less the samples after the row's end,
+        the start of a row is taken one row duration before its end.
+        '''
+        if self.sdr is None:
+            LOGGER.warning('please configure the SDR')
+            return None
+
+        raw = buffer.dtype == np.uint8
+        width = self.n * self.super_sample
+        row_bytes = 2 * width
+        transfer = min(TRANSFER_BYTES, row_bytes)
+        period = width / self.sample_rate  # seconds of sky per row
+        transfer_period = transfer / 2 / self.sample_rate
+        ring = np.empty((slots, transfer), dtype=np.uint8)
+        stamps = np.zeros(slots)
+        monotonic_stamps = np.zeros(slots, dtype=np.int64)
+        free = queue.Queue()
+        filled = queue.Queue()
+        for slot in range(slots):
+            free.put(slot)
+        stats = StreamStats()
+        first = last = 0.
+
+        def callback(values, context):
+            nonlocal first, last
+            last = time.perf_counter()
+            if stats.received == 0:
+                first = last
+            stats.received += 1
+            try:
+                slot = free.get_nowait()
+            except queue.Empty:
+                stats.overflows += 1
+                filled.put(GAP)
+                return
+            ring[slot] = np.ctypeslib.as_array(values)
+            stamps[slot] = time.time()
+            monotonic_stamps[slot] = time.monotonic_ns()
+            filled.put(slot)
+
+        reader = threading.Thread(target=self.sdr.read_bytes_async,
+                                  args=(callback, transfer))
+        LOGGER.info(f'starting stream {N} rows, {transfer} byte transfers, {slots} slots')
+        reader.start()
+        row = np.empty(row_bytes, dtype=np.uint8)
+        fill = 0  # bytes of the row in progress
+        broken = False  # an overflow since the last transfer
+        i = 0
+        while i < N:
+            try:
+                slot = filled.get(timeout=max(1., 10 * period))
+            except queue.Empty:
+                LOGGER.error(f'stream stalled at row {i}')
+                break
+            if slot == GAP:
+                # the row across the gap is lost, skipping its index tells the
+                # writer (DDCRows) that the next row does not continue the last
+                if not broken:
+                    stats.discarded += 1
+                    i += 1
+                    broken = True
+                fill = 0
+                continue
+            broken = False
+            offset = 0
+            while offset < transfer and i < N:
+                take = min(transfer - offset, row_bytes - fill)
+                row[fill:fill + take] = ring[slot, offset:offset + take]
+                fill += take
+                offset += take
+                if fill < row_bytes:
+                    break
+                # the samples of the transfer after the row were read later
+                after = (transfer - offset) / 2 / self.sample_rate
+                if raw and not isinstance(buffer, ndarray):
+                    # a writer may keep the row (queue, pairing), assemble the next in a new one
+                    buffer[i] = row
+                    row = np.empty(row_bytes, dtype=np.uint8)
+                elif raw:
+                    buffer[i] = row
+                else:
+                    buffer[i] = bytes_to_iq(row)
+                if timestamps is not None:
+                    timestamps[i] = stamps[slot] - after
+                if monotonic is not None:
+                    end = monotonic_stamps[slot] - int(after * 1e9)
+                    monotonic[i] = end - int(period * 1e9), end
+                if valid is not None:
+                    valid[i] = True
+                stats.rows += 1
+                fill = 0
+                i += 1
+            free.put(slot)
+        if reader.is_alive():
+            self.sdr.cancel_read_async()
+        reader.join()
+
+        if stats.received > 0:
+            stats.elapsed = last - first + transfer_period
+            stats.dropped = max(0, round((last - first) / transfer_period) - (stats.received - 1))
+            stats.duty_cycle = stats.rows * period / stats.elapsed
+        LOGGER.info(f'complete {stats.rows} rows, {stats.duty_cycle=:.4f}')
+        if stats.overflows > 0 or stats.dropped > 0:
+            LOGGER.warning(f'{stats.overflows=} {stats.dropped=} {stats.discarded=}')
+        self.stream_stats = stats
+        return stats
+
+
+class RowWriter:
+    '''
+    Resizable, row-chunked dataset written one row at a time.
+
+    Supports the buffer[i] = row assignment of SDR.integrateN/streamN, so a
+    capture only holds the row in flight, and the file is flushed after each
+    row so the rows written so far stay readable if the capture dies.
+    '''
+
+    def __init__(self, group: h5py.Group, name: str, width: int, dtype, **kwargs):
+        self.dataset = group.create_dataset(name, shape=(0, width),
+                                            maxshape=(None, width),
+                                            chunks=(1, width), dtype=dtype,
+                                            **kwargs)
+        self.dtype = self.dataset.dtype
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __setitem__(self, i: int, row: ndarray):
+        if i >= len(self.dataset):
+            self.dataset.resize(i + 1, axis=0)
+        self.dataset[i] = row
+        self.dataset.file.flush()
+
+
+class QueuedRows:
+    '''
+    RowWriter stand-in which hands rows to a PipelineWriter.
+
+    The rows are queued as they are: SDR.integrateN and streamN hand a
+    writer fresh arrays which the reader does not reuse.
+    '''
+
+    def __init__(self, pipeline: 'PipelineWriter', writer: RowWriter):
+        self.pipeline = pipeline
+        self.writer = writer
+        self.dtype = writer.dtype
+        self.wait_time = 0.  # seconds blocked on a full queue
+
+    def __setitem__(self, i: int, row: ndarray):
+        start = time.perf_counter()
+        self.pipeline.put(self.writer, i, row)
+        self.wait_time += time.perf_counter() - start
+
+
+class DDCRows:
+    '''
+    RowWriter stand-in which downconverts and decimates each row (dsp.DDC)
+    into writer: complex64 rows of width / factor, or with quantize the
+    interleaved int16 (DDC_ATTRS) of a RowWriter.
+
+    Rows carry the DDC series from one to the next, a lost row restarts it.
+    '''
+
+    def __init__(self, ddc: dsp.DDC, writer, raw: bool = False, quantize: bool = False):
+        self.ddc = ddc
+        self.writer = writer
+        self.dtype = np.dtype(np.uint8 if raw else np.complex128)
+        self.quantize = quantize
+        self.last = -1
+
+    def __setitem__(self, i: int, row: ndarray):
+        if i != self.last + 1:
+            self.ddc.reset()
+        self.last = i
+        if self.dtype == np.uint8:
+            row = bytes_to_iq(row, np.complex64)
+        iq = self.ddc(row.astype(np.complex64, copy=False))
+        if self.quantize:
+            iq = (iq.view(np.float32) / np.float32(DDC_SCALE)).round().clip(-2**15 + 1, 2**15 - 1)
+            iq = iq.astype(np.int16)
+        self.writer[i] = iq
+
+
+class PipelineWriter:
+    '''
+    Writer thread draining a queue of finished rows into the file.
+
+    Compression and disk writes of one sweep step overlap the acquisition
+    of the next. The queue holds at most max_bytes of rows (a larger row
+    still passes alone), when the disk falls behind it fills up and
+    QueuedRows blocks the acquisition threads (backpressure).
+
+    A context manager entered inside the file it writes, so the queued rows
+    are drained before the file closes, on errors too. The rows were
+    flagged valid when queued, so close() re-raises the first failed write
+    rather than leave lost rows flagged valid.
+    '''
+
+    def __init__(self, max_bytes: int = PIPELINE_BYTES):
+        self.queue = queue.Queue()
+        self.max_bytes = max_bytes
+        self.queued = 0  # bytes of the rows in the queue
+        self.space = threading.Condition()
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def rows(self, writer: RowWriter) -> QueuedRows:
+        return QueuedRows(self, writer)
+
+    def put(self, writer: RowWriter, i: int, row: ndarray):
+        '''Queue row i for writer, once max_bytes leave room for it. '''
+        with self.space:
+            self.space.wait_for(lambda: self.queued == 0
+                                or self.queued + row.nbytes <= self.max_bytes)
+            self.queued += row.nbytes
+        self.queue.put((writer, i, row))
+
+    def defer(self, fn):
+        '''Call fn on the writer thread once the rows queued so far are written. '''
+        self.queue.put((fn,))
+
+    def run(self):
+        while (item := self.queue.get()) is not None:
+            try:
+                match item:
+                    case (writer, i, row):
+                        try:
+                            writer[i] = row
+                        finally:
+                            with self.space:
+                                self.queued -= row.nbytes
+                                self.space.notify_all()
+                    case (fn,):
+                        fn()
+            except Exception as e:
+                LOGGER.exception(e)
+                self.errors.append(e)
+            self.queue.task_done()
+        self.queue.task_done()
+
+    def close(self):
+        LOGGER.info(f'draining {self.queue.qsize()} queued rows')
+        self.queue.put(None)
+        self.thread.join()
+        if self.errors:
+            LOGGER.error(f'{len(self.errors)} queued writes failed')
+            raise self.errors[0]
+
+
+class SpectrometerRows:
+    '''RowWriter stand-in feeding one channel of a SpectrometerWriter. '''
+
+    def __init__(self, spectrometer: 'SpectrometerWriter', name: str):
+        self.spectrometer = spectrometer
+        self.name = name
+        self.dtype = spectrometer.dtype
+
+    def __setitem__(self, i: int, row: ndarray):
+        self.spectrometer.add(self.name, i, row)
+
+
+class SpectrometerWriter:
+    '''
+    Spectrometer mode: accumulate the PSD of each row instead of storing IQ.
+
+    The signal and reference rows are paired by index for the signal -
+    reference spectrum. A row waits for its partner while the other channel
+    has not gone past its index, at most PENDING_BYTES of rows per channel
+    (the oldest give up first), so a lagging or dead channel does not hold
+    rows without bound. Rows whose partner was lost are counted in the
+    spectrometer_unpaired attr [signal, reference]. close() writes the
+    integrated spectra to the group. With dump_every, row b of the
+    *_psd_dumps datasets is the spectrum of rows skip + b * dump_every to
+    skip + (b + 1) * dump_every - 1 of that channel, stored once the
+    channel has gone past them (nan if they were all lost), so the dumps of
+    the three channels cover the same rows. Rows before skip are ignored,
+    as reduce.py ignores the first row of a data set.
+
+    With rfi, the channels of each row flagged by dsp.rfi_flags are left out
+    of the spectra, and the flags are stored as packed bits (ascending
+    frequency, numpy.packbits) in row - skip of the *_rfi_mask datasets,
+    the fraction of rows flagged per channel as *_rfi_occupancy.
+    '''
+    CHANNELS = ('signal', 'reference', 'corrected')
+    PENDING_BYTES = 2**26  # rows of a channel waiting for their partner, as delivered
+
+    def __init__(self, group: h5py.Group, sample_rate: float, raw: bool = False,
+                 dump_every: int = 0, skip: int = 1,
+                 nbins: int = dsp.NBINS, N_SEG_LIM: int = dsp.N_SEG_LIM, rfi: bool = False):
+        self.group = group
+        self.sample_rate = sample_rate
+        self.dump_every = dump_every
+        self.skip = skip
+        self.rfi = rfi
+        self.dtype = np.dtype(np.uint8 if raw else np.complex128)
+        self.spectrometers = {name: dsp.Spectrometer(nbins, N_SEG_LIM)
+                              for name in self.CHANNELS}
+        self.pending = {'signal': dict(), 'reference': dict()}
+        self.latest = {'signal': -1, 'reference': -1}   # index of the last row added
+        self.unpaired = {'signal': 0, 'reference': 0}   # rows whose partner was lost
+        self.lock = threading.Lock()
+        # the corrected rows are accumulated in the order their pairs completed
+        self.paired = 0
+        self.accumulated = 0
+        self.turn = threading.Condition()
+        self.dumped = {name: 0 for name in self.CHANNELS}  # blocks stored per channel
+        if dump_every:
+            for name in self.CHANNELS:
+                group.create_dataset(f'{name}_psd_dumps', shape=(0, nbins),
+                                     maxshape=(None, nbins), chunks=(1, nbins),
+                                     dtype=np.float64)
+        if rfi:
+            width = -(-nbins // 8)
+            for name in self.CHANNELS:
+                group.create_dataset(f'{name}_rfi_mask', shape=(0, width),
+                                     maxshape=(None, width), chunks=(64, width),
+                                     dtype=np.uint8, compression='gzip')
+
+    def channel(self, name: str) -> SpectrometerRows:
+        return SpectrometerRows(self, name)
+
+    def add(self, name: str, i: int, row: ndarray):
+        if i < self.skip:
+            return
+        # 8 bit samples lose nothing in complex64, which halves the FFT work
+        iq = bytes_to_iq(row, np.complex64) if self.dtype == np.uint8 else row
+        P, flags = self.psd(self.spectrometers[name], iq)
+        other = 'reference' if name == 'signal' else 'signal'
+        with self.lock:
+            self.add_power(name, i, P, flags)
+            self.latest[name] = i
+            paired = self.pending[other].pop(i, None)
+            # rows arrive in order, the other channel's rows before i lost their pair
+            for j in [j for j in self.pending[other] if j < i]:
+                del self.pending[other][j]
+                self.unpaired[other] += 1
+            if paired is None:
+                if self.latest[other] > i:
+                    self.unpaired[name] += 1
+                else:
+                    # a waiting row is kept as delivered, raw rows are 8x smaller
+                    pending = self.pending[name]
+                    pending[i] = row
+                    while sum(row.nbytes for row in pending.values()) > self.PENDING_BYTES:
+                        del pending[min(pending)]
+                        self.unpaired[name] += 1
+                return
+            if self.dtype == np.uint8:
+                paired = bytes_to_iq(paired, np.complex64)
+            ticket = self.paired
+            self.paired += 1
+        P = None
+        try:
+            corrected = iq - paired if name == 'signal' else paired - iq
+            P, flags = self.psd(self.spectrometers['corrected'], corrected)
+        finally:
+            # the pairs complete in index order, their psds may not
+            with self.turn:
+                self.turn.wait_for(lambda: self.accumulated == ticket)
+                if P is not None:
+                    with self.lock:
+                        self.add_power('corrected', i, P, flags)
+                self.accumulated += 1
+                self.turn.notify_all()
+
+    def psd(self, spectrometer: dsp.Spectrometer, row: ndarray) -> tuple[ndarray, None | ndarray]:
+        '''The psd of a row and, with rfi, its flags. '''
+        if self.rfi:
+            return spectrometer.flagged_psd(row)
+        return spectrometer.psd(row), None
+
+    def add_power(self, name: str, i: int, P: ndarray, flags: None | ndarray):
+        '''Accumulate row i of channel name and store its flags, under the lock. '''
+        if self.dump_every:
+            # row i completes the blocks of this channel before its own
+            self.dump(name, (i - self.skip) // self.dump_every)
+        self.spectrometers[name].add_power(P, flags=flags)
+        if flags is None:
+            return
+        # rows lost before i leave their place in the mask zero
+        dataset = self.group[f'{name}_rfi_mask']
+        if len(dataset) <= i - self.skip:
+            dataset.resize(i - self.skip + 1, axis=0)
+        dataset[i - self.skip] = np.packbits(np.fft.fftshift(flags))
+
+    def dump(self, name: str, blocks: int):
+        '''Store the spectra of the blocks of channel name before blocks, nan if all rows were lost. '''
+        dataset = self.group[f'{name}_psd_dumps']
+        while self.dumped[name] < blocks:
+            spectrometer = self.spectrometers[name]
+            if spectrometer.block_rows:
+                P = self.density(spectrometer.dump())
+            else:
+                P = np.full(spectrometer.nbins, np.nan)
+            if len(dataset) <= self.dumped[name]:
+                dataset.resize(self.dumped[name] + 1, axis=0)
+            dataset[self.dumped[name]] = P
+            self.dumped[name] += 1
+
+    def density(self, P: ndarray) -> ndarray:
+        '''Shifted to ascending frequency, per Hz. '''
+        spectrometer = self.spectrometers['signal']
+        return np.fft.fftshift(dsp.density(P, self.sample_rate, spectrometer.nperseg,
+                                           spectrometer.window))
+
+    def close(self):
+        for name, rows in self.pending.items():
+            self.unpaired[name] += len(rows)
+            if self.unpaired[name]:
+                LOGGER.warning(f'{self.unpaired[name]} {name} rows without a pair')
+        self.pending = {'signal': dict(), 'reference': dict()}
+        if self.dump_every:
+            # the last block is complete if the group's rows fill it
+            blocks = (int(self.group.attrs['row']) - self.skip) // self.dump_every
+            for name in self.CHANNELS:
+                self.dump(name, blocks)
+        spectrometer = self.spectrometers['signal']
+        self.group.create_dataset('psd_frequency', data=np.fft.fftshift(
+            dsp.frequencies(spectrometer.nbins, self.sample_rate)) + self.group.attrs['frequency'])
+        for name in self.CHANNELS:
+            self.group.create_dataset(f'{name}_psd', data=self.density(self.spectrometers[name].mean()))
+        self.group.attrs['spectrometer_rows'] = [self.spectrometers[name].rows for name in self.CHANNELS]
+        self.group.attrs['spectrometer_unpaired'] = [self.unpaired['signal'], self.unpaired['reference']]
+        if self.rfi:
+            for name in self.CHANNELS:
+                spectrometer = self.spectrometers[name]
+                occupancy = 1 - spectrometer.counts / max(spectrometer.rows, 1)
+                self.group.create_dataset(f'{name}_rfi_occupancy', data=np.fft.fftshift(occupancy))
+            self.group.attrs['rfi_sk_sigma'] = dsp.SK_SIGMA
+            self.group.attrs['rfi_mad_sigma'] = dsp.MAD_SIGMA
+        self.group.attrs['nbins'] = spectrometer.nbins
+        self.group.attrs['nperseg'] = spectrometer.nperseg
+        self.group.attrs['window'] = spectrometer.window
+
+
+def alignment(monotonic_sig: ndarray, monotonic_ref: ndarray, valid_sig: ndarray,
+              valid_ref: ndarray) -> dict:
+    '''
+    Summarize the (row, [start, end]) monotonic read times of both channels.
+
+    skew: signal - reference read start of the rows captured on both (s)
+    latency: percentiles of read end - start (s), [signal, reference]
+    interval, jitter: mean and standard deviation of the time between the
+                      starts of consecutive rows (s), [signal, reference]
+    '''
+    percentiles = {'latency_p50': 50, 'latency_p95': 95, 'latency_p99': 99, 'latency_max': 100}
+    both = valid_sig & valid_ref
+    skew = (monotonic_sig[both, 0] - monotonic_ref[both, 0]) / 1e9
+    summary = {
+            'skew_mean': skew.mean() if len(skew) else np.nan,
+            'skew_std': skew.std() if len(skew) else np.nan,
+            'skew_max': np.abs(skew).max() if len(skew) else np.nan,
+            **{name: list() for name in percentiles},
+            'interval': list(),
+            'jitter': list(),
+            }
+    for monotonic, valid in ((monotonic_sig, valid_sig), (monotonic_ref, valid_ref)):
+        latency = (monotonic[valid, 1] - monotonic[valid, 0]) / 1e9
+        interval = np.diff(monotonic[valid, 0]) / 1e9
+        for name, q in percentiles.items():
+            summary[name].append(np.percentile(latency, q) if len(latency) else np.nan)
+        summary['interval'].append(interval.mean() if len(interval) else np.nan)
+        summary['jitter'].append(interval.std() if len(interval) else np.nan)
+    return summary
 
 
 def raw_data_to_file(data: ndarray, fname: Path | str):
@@ -186,14 +841,14 @@ def raw_data_to_file(data: ndarray, fname: Path | str):
     LOGGER.info(f'wrote data to {fname}')
 
 
-def write_h5py(data: ndarray, meta: dict, fname: Path | str):
+def write_h5py(data: ndarray, meta: dict, fname: Path | str,
+               compression: str = DEFAULT_CODEC):
     LOGGER.warning('deprecated')
-    LOGGER.info(f'compressing and writing data to {fname}.h5')
+    LOGGER.info(f'compressing ({compression}) and writing data to {fname}.h5')
     with h5py.File(f'{fname}.h5', 'w') as f:
         f.create_dataset('IQ',
                          data=data,
-                         compression='gzip',
-                         compression_opts=5)
+                         **codec(compression))
         LOGGER.info('adding in metadata')
         for key in meta['set']:
             val = meta['set'][key]
@@ -218,14 +873,68 @@ def read_h5py(fname: Path | str) -> tuple[ndarray, dict]:
 def collect(freqs: list[float], sample_rates: list[float], ns: list[int],
             rows: list[int], super_samples: list[int], gain: float,
             genConf: ConfGeneral, teleConf: ConfTelescope,
-            fname: str | Path):
+            fname: str | Path, stream: bool = False, raw: bool = False,
+            compression: str = DEFAULT_CODEC, pipeline: bool = False,
+            pipeline_bytes: int = PIPELINE_BYTES,
+            spectrometer: bool = False, dump_every: int = 0, memmap: bool = False,
+            ddc: int = 1, ddc_frequency: float = HI_FREQUENCY, rfi: bool = False):
     '''
     The provided list parameters overide the associate value in the Conf
     structures. These iterations form the observation, 
     they are performed in sequence in a cartesian product
     freq x sample rate x n x row x super_sample
+
+    stream: acquire with SDR.streamN (async reads) instead of SDR.integrateN
+    raw: store the interleaved uint8 IQ as delivered by the device,
+         (row, 2 * width) per dataset, instead of complex128
+    compression: codec of the IQ/reference datasets, see compression.CODECS
+    pipeline: compress and write rows on a writer thread, overlapping the
+              acquisition of the next sweep step
+    pipeline_bytes: most bytes of rows waiting for the pipeline writer
+    spectrometer: store the integrated signal, reference and signal -
+                  reference spectra (SpectrometerWriter) instead of IQ
+    dump_every: in spectrometer mode, also store the spectra of every
+                dump_every rows
+    memmap: write a rawcapture.Capture directory {fname}.raw of flat
+            uncompressed uint8 rows instead of {fname}.h5, implies raw
+    ddc: decimation factor of a digital downconversion (dsp.DDC) of every
+         row to the band around ddc_frequency before it is stored, 1 for
+         none. The rows are stored as int16 IQ (DDC_ATTRS) and the group attrs
+         frequency and sample_rate describe the stored band, the tuned
+         ones are kept as tuned_frequency and tuned_sample_rate next to
+         decimation and band_edges (Hz).
+    rfi: in spectrometer mode, flag RFI in every row (spectral kurtosis and
+         MAD outliers, dsp.rfi_flags) and leave the flagged channels out of
+         the spectra, see SpectrometerWriter
+
+    The time the radios sit idle between sweep steps is logged and stored
+    as the idle_time group attr (seconds before the step started).
     '''
-    with h5py.File(f'{fname}.h5', 'w') as file:
+    if rfi and not spectrometer:
+        raise ValueError('rfi flags spectrometer rows, flag IQ captures with reduce.py rfi')
+    if memmap and spectrometer:
+        raise ValueError('the memmap format stores IQ rows, not spectra')
+    if memmap and ddc > 1:
+        raise ValueError('the memmap format stores raw uint8 rows, not downconverted ones')
+    if ddc > 1:
+        for freq, sr, n, ss in product(freqs, sample_rates, ns, super_samples):
+            low, high = dsp.DDC(sr, ddc_frequency - freq, ddc).band
+            if (n * ss) % ddc:
+                raise ValueError(f'rows of {n * ss} samples do not decimate by {ddc}')
+            if low < -sr / 2 or high > sr / 2:
+                raise ValueError(f'the band {freq + low} - {freq + high} Hz is outside '
+                                 f'the {sr} Hz tuned at {freq} Hz')
+    if memmap:
+        raw = True
+        compression = 'none'
+    # an unknown codec raises before the output is created
+    codec_kwargs = codec(compression)
+    if memmap:
+        output = rawcapture.Capture(f'{fname}{rawcapture.SUFFIX}', 'w')
+    else:
+        output = h5py.File(f'{fname}.h5', 'w')
+    with output as file, SDRPool() as pool, \
+            (PipelineWriter(pipeline_bytes) if pipeline else nullcontext()) as pipe:
         genConf.initialize()
         LOGGER.debug('writing out General configuration')
         file.attrs['latitude'] = genConf.latitude
@@ -244,47 +953,135 @@ def collect(freqs: list[float], sample_rates: list[float], ns: list[int],
         file.attrs['sample_rate'] = sample_rates
         file.attrs['n'] = ns
         file.attrs['super_sample'] = super_samples
+        file.attrs['compression'] = compression
+        if ddc > 1:
+            file.attrs['decimation'] = ddc
+            file.attrs['ddc_frequency'] = ddc_frequency
         # make the data group
         offset = timedelta(hours=-10)
         tz = timezone(offset)
+        idle_start = None
         for i, (freq, sr, n, row, ss) in enumerate(product(freqs, sample_rates, ns, rows, super_samples)):
             LOGGER.info(f'Integrating: {freq=} {sr=} {n=} {row=} {ss=}')
             sdr = SDR(center_freq=freq, gain=gain, sample_rate=sr, n=n,
                       super_sample=ss, serial_number=teleConf.signal_sn)
-            sdr.configure()
+            sdr.configure(pool)
             reference = SDR(center_freq=freq, gain=gain, sample_rate=sr, n=n,
                             super_sample=ss, serial_number=teleConf.reference_sn)
-            reference.configure()
+            reference.configure(pool)
 
-            # setup data buffers
+            group = file.create_group(f'data/{i}')
+            group.attrs['frequency'] = freq
+            group.attrs['sample_rate'] = sr
+            group.attrs['n'] = n
+            group.attrs['row'] = row
+            group.attrs['super_sample'] = ss
+            # [signal, reference]
+            group.attrs['retune_time'] = [sdr.retune_time, reference.retune_time]
+            group.attrs['settle_time'] = [sdr.settle_time, reference.settle_time]
+
+            # setup data sets, rows are appended as they are integrated
             width = sdr.n * sdr.super_sample
-            data_sig = np.zeros((row, width), dtype=np.complex128)
-            data_ref = np.zeros((row, width), dtype=np.complex128)
+            if ddc > 1:
+                # the stored band replaces the tuned one, kept as tuned_*
+                ddcs = [dsp.DDC(sr, ddc_frequency - freq, ddc) for _ in range(2)]
+                low, high = ddcs[0].band
+                group.attrs['frequency'] = ddc_frequency
+                group.attrs['sample_rate'] = sr / ddc
+                group.attrs['tuned_frequency'] = freq
+                group.attrs['tuned_sample_rate'] = sr
+                group.attrs['decimation'] = ddc
+                group.attrs['band_edges'] = [freq + low, freq + high]
+            if spectrometer and ddc > 1:
+                spectra = SpectrometerWriter(group, sr / ddc, False, dump_every, rfi=rfi)
+                data_sig = DDCRows(ddcs[0], spectra.channel('signal'), raw)
+                data_ref = DDCRows(ddcs[1], spectra.channel('reference'), raw)
+            elif spectrometer:
+                spectra = SpectrometerWriter(group, sr, raw, dump_every, rfi=rfi)
+                data_sig = spectra.channel('signal')
+                data_ref = spectra.channel('reference')
+            elif ddc > 1:
+                writers = [RowWriter(group, name, 2 * width // ddc, np.int16, **codec_kwargs)
+                           for name in ('IQ', 'reference')]
+                for writer in writers:
+                    writer.dataset.attrs.update(DDC_ATTRS)
+                data_sig, data_ref = (DDCRows(converter, writer, raw, quantize=True)
+                                      for converter, writer in zip(ddcs, writers))
+            elif memmap:
+                data_sig = group.create_rows('IQ', row, 2 * width, RAW_ATTRS)
+                data_ref = group.create_rows('reference', row, 2 * width, RAW_ATTRS)
+            elif raw:
+                data_sig = RowWriter(group, 'IQ', 2 * width, np.uint8, **codec_kwargs)
+                data_ref = RowWriter(group, 'reference', 2 * width, np.uint8, **codec_kwargs)
+                for writer in (data_sig, data_ref):
+                    writer.dataset.attrs.update(RAW_ATTRS)
+            else:
+                data_sig = RowWriter(group, 'IQ', width, np.complex128, **codec_kwargs)
+                data_ref = RowWriter(group, 'reference', width, np.complex128, **codec_kwargs)
+            if pipeline:
+                data_sig = pipe.rows(data_sig)
+                data_ref = pipe.rows(data_ref)
 
-            thread_data = threading.Thread(target=sdr.integrateN, args=(row, data_sig))
-            thread_reference = threading.Thread(target=reference.integrateN, args=(row, data_ref))
+            # per row capture flag and time.time() stamp, stored next to the data
+            valid_sig = np.zeros(row, dtype=bool)
+            valid_ref = np.zeros(row, dtype=bool)
+            time_sig = np.full(row, np.nan)
+            time_ref = np.full(row, np.nan)
+            # per row time.monotonic_ns() at the read start and end
+            monotonic_sig = np.zeros((row, 2), dtype=np.int64)
+            monotonic_ref = np.zeros((row, 2), dtype=np.int64)
+
+            if stream:
+                thread_data = threading.Thread(target=sdr.streamN, args=(row, data_sig, valid_sig, time_sig, monotonic_sig))
+                thread_reference = threading.Thread(target=reference.streamN, args=(row, data_ref, valid_ref, time_ref, monotonic_ref))
+            else:
+                thread_data = threading.Thread(target=sdr.integrateN, args=(row, data_sig, valid_sig, time_sig, monotonic_sig))
+                thread_reference = threading.Thread(target=reference.integrateN, args=(row, data_ref, valid_ref, time_ref, monotonic_ref))
 
             start = datetime.now(tz)
+            group.attrs['obs_start_time'] = start.isoformat()
+            if idle_start is not None:
+                idle = time.perf_counter() - idle_start
+                group.attrs['idle_time'] = idle
+                LOGGER.info(f'radios idle {idle:.4f} s before step {i}')
             thread_data.start()
             thread_reference.start()
 
             thread_data.join()
             thread_reference.join()
+            idle_start = time.perf_counter()
             end = datetime.now(tz)
 
-            group = file.create_group(f'data/{i}')
-            group.create_dataset('IQ', data=data_sig, compression='gzip', compression_opts=5)
-            group.create_dataset('reference', data=data_ref, compression='gzip', compression_opts=5)
-
-            # write meta data for the data set
-            group.attrs['frequency'] = freq
-            group.attrs['sample_rate'] = sr
-            group.attrs['n'] = n
-            group.attrs['row'] = row
-            group.attrs['super_sample'] = ss
-            group.attrs['obs_start_time'] = start.isoformat()
             group.attrs['obs_end_time'] = end.isoformat()
-
+            group.create_dataset('IQ_valid', data=valid_sig)
+            group.create_dataset('reference_valid', data=valid_ref)
+            group.create_dataset('IQ_time', data=time_sig)
+            group.create_dataset('reference_time', data=time_ref)
+            LOGGER.info(f'valid rows {valid_sig.sum()}/{row} {valid_ref.sum()}/{row}')
+            group.create_dataset('IQ_monotonic', data=monotonic_sig)
+            group.create_dataset('reference_monotonic', data=monotonic_ref)
+            summary = alignment(monotonic_sig, monotonic_ref, valid_sig, valid_ref)
+            for key, val in summary.items():
+                group.attrs[key] = val
+            LOGGER.info(f'channel skew {summary["skew_mean"]:.6f} s '
+                        f'(std {summary["skew_std"]:.6f} s, max {summary["skew_max"]:.6f} s), '
+                        f'jitter {summary["jitter"]}')
+            if summary['skew_max'] > width / sr:
+                LOGGER.warning('channels drifted more than a row apart, '
+                               'signal - reference is not simultaneous')
+            if stream:
+                # [signal, reference]
+                group.attrs['duty_cycle'] = [sdr.stream_stats.duty_cycle, reference.stream_stats.duty_cycle]
+                group.attrs['overflows'] = [sdr.stream_stats.overflows, reference.stream_stats.overflows]
+                group.attrs['dropped'] = [sdr.stream_stats.dropped, reference.stream_stats.dropped]
+            if spectrometer and pipeline:
+                pipe.defer(spectra.close)
+            elif spectrometer:
+                spectra.close()
+            if pipeline:
+                # [signal, reference]
+                group.attrs['backpressure_time'] = [data_sig.wait_time, data_ref.wait_time]
+                LOGGER.info(f'backpressure {data_sig.wait_time:.4f} s {data_ref.wait_time:.4f} s')
         LOGGER.info(f'integrated {i + 1} times')
 
 
@@ -310,7 +1107,7 @@ if __name__ == '__main__':
                         help=f'sample rate, default {SAMPLE_RATES} Hz')
     parser.add_argument('--n', '-n', default=NS, type=int,
                         nargs='+',
-                        help=f'how many samples per call to the ADC (powers of 2 only!), default {ns}')
+                        help=f'how many samples per call to the ADC (powers of 2 only!), default {NS}')
     parser.add_argument('--rows', '-r', default=ROWS, type=int,
                         nargs='+',
                         help=f'how many rows of data to take, default {ROWS}')
@@ -319,11 +1116,43 @@ if __name__ == '__main__':
                         help=f'multiplies the sample width, default {SUPER_SAMPLES}')
     parser.add_argument('--data', default=DATA_DIR, type=Path,
                         help=f'define the directory to store the data files in, default {DATA_DIR}')
+    parser.add_argument('--stream', default=False, action='store_true',
+                        help='pass to acquire rows with continuous async reads')
+    parser.add_argument('--raw', default=False, action='store_true',
+                        help='pass to store native uint8 IQ instead of complex128')
+    parser.add_argument('--compression', '-c', default=DEFAULT_CODEC,
+                        help=f'dataset codec, one of {CODECS}, default {DEFAULT_CODEC}')
+    parser.add_argument('--pipeline', default=False, action='store_true',
+                        help='pass to write rows on a writer thread while the next step integrates')
+    parser.add_argument('--pipeline_mb', default=PIPELINE_BYTES // 2**20, type=int,
+                        help=f'with --pipeline, most MB of rows queued for the writer, default {PIPELINE_BYTES // 2**20}')
+    parser.add_argument('--spectrometer', default=False, action='store_true',
+                        help='pass to store integrated spectra instead of IQ')
+    parser.add_argument('--dump_every', default=0, type=int,
+                        help='with --spectrometer, also store the spectra of every N rows')
+    parser.add_argument('--rfi', default=False, action='store_true',
+                        help='with --spectrometer, flag RFI in every row and leave it out of the spectra')
+    parser.add_argument('--memmap', default=False, action='store_true',
+                        help='pass to write flat uncompressed raw rows (rawcapture.py) instead of HDF5')
+    parser.add_argument('--ddc', default=1, type=int,
+                        help='decimation of a digital downconversion to the band around --ddc_frequency before storage, default 1 (off)')
+    parser.add_argument('--ddc_frequency', default=HI_FREQUENCY, type=float,
+                        help=f'centre of the --ddc band, default {HI_FREQUENCY} Hz')
     parser.add_argument('--note', help='note describing the dataset')
     parser.add_argument('--tele_note', help='note describing the telescope')
     parser.add_argument('--tele_name', help='name of the telescope and/or configuration')
 
     args = parser.parse_args()
+    try:
+        codec(args.compression)
+    except (ValueError, ImportError) as e:
+        parser.error(f'--compression: {e}')
+    if args.rfi and not args.spectrometer:
+        parser.error('--rfi flags --spectrometer rows, flag IQ captures with reduce.py rfi')
+    if args.memmap and args.spectrometer:
+        parser.error('--memmap stores IQ rows, not spectra')
+    if args.memmap and args.ddc > 1:
+        parser.error('--memmap stores raw rows, not downconverted ones')
 
     if not (args.data.exists() and args.data.is_dir()):
         args.data.mkdir()
@@ -340,4 +1169,15 @@ if __name__ == '__main__':
             args.gain,
             genConf,
             teleConf,
-            args.data / genConf.timestamp())
+            args.data / genConf.timestamp(),
+            stream=args.stream,
+            raw=args.raw,
+            compression=args.compression,
+            pipeline=args.pipeline,
+            pipeline_bytes=args.pipeline_mb * 2**20,
+            spectrometer=args.spectrometer,
+            dump_every=args.dump_every,
+            memmap=args.memmap,
+            ddc=args.ddc,
+            ddc_frequency=args.ddc_frequency,
+            rfi=args.rfi)
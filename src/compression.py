@@ -0,0 +1,44 @@
+'''
+HDF5 compression codecs for capture files.
+
+The byte oriented codecs (bitshuffle-lz4, lz4, zstd) need hdf5plugin, both
+to write and to read files which use them.
+'''
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+DEFAULT_CODEC = 'gzip-5'
+CODECS = ['none', 'lzf', 'gzip-N', 'shuffle-lzf', 'bitshuffle-lz4', 'lz4', 'zstd']
+
+
+def codec(name: str) -> dict:
+    '''
+    Return the h5py create_dataset keyword arguments for a codec.
+
+    name is one of CODECS, gzip takes its level as a suffix, e.g. gzip-1.
+    '''
+    match name.split('-'):
+        case ['none']:
+            return {}
+        case ['lzf']:
+            return {'compression': 'lzf'}
+        case ['gzip']:
+            return {'compression': 'gzip', 'compression_opts': 5}
+        case ['gzip', level] if level.isdigit() and 0 <= int(level) <= 9:
+            return {'compression': 'gzip', 'compression_opts': int(level)}
+        case ['shuffle', 'lzf']:
+            return {'shuffle': True, 'compression': 'lzf'}
+        case ['bitshuffle', 'lz4'] | ['lz4'] | ['zstd'] if hdf5plugin is None:
+            raise ImportError(f'the {name} codec requires hdf5plugin')
+        case ['bitshuffle', 'lz4']:
+            # bit planes of noise-like 8-bit samples: the high bits barely change
+            return dict(hdf5plugin.Bitshuffle(cname='lz4'))
+        case ['lz4']:
+            return dict(hdf5plugin.LZ4())
+        case ['zstd']:
+            return dict(hdf5plugin.Zstd())
+        case _:
+            raise ValueError(f'unknown codec {name}, choose from {CODECS}')
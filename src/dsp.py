@@ -0,0 +1,507 @@
+'''
+Signal processing shared by collect.py (on the telescope) and reduce.py.
+
+Every transform goes through fft()/ifft(), the backend set by
+fft_backend(). scipy.fft keeps its plans between calls of the same length
+and splits a batch of rows over FFT_WORKERS threads.
+'''
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
+from numpy import ndarray
+from scipy.signal import get_window, cheby1, sosfilt, sosfilt_zi, firwin, upfirdn
+import scipy.fft
+from scipy.fft import next_fast_len
+
+
+WINDOW = 'hann'
+NBINS = 8192      # FFT length (zero padded)
+N_SEG_LIM = 2048  # longest segment
+BATCH_BYTES = 2**27  # working memory of the segment spectra of one psd() batch
+MAX_STAGE = 10    # largest decimation factor of one Decimator stage
+WARMUP = 1024     # samples setting the initial state of a Decimator
+PFB_TAPS = 4      # polyphase filterbank taps per channel
+DDC_TAPS = 16     # FIR taps of a DDC per unit of decimation
+DDC_PASSBAND = 0.8  # of the decimated Nyquist band kept by a DDC
+SK_SIGMA = 5.     # RFI threshold of the spectral kurtosis, standard deviations about 1
+MAD_SIGMA = 6.    # RFI threshold of the power, robust standard deviations above the bandpass
+BANDPASS_CHANNELS = 64  # channels of a block median estimating the bandpass
+FFT_BACKENDS = ('scipy', 'numpy')
+FFT_BACKEND = 'scipy'  # set by fft_backend()
+FFT_WORKERS = 1   # threads of a scipy.fft transform, -1 for one per CPU, set by fft_backend()
+
+
+def fft_backend(backend: str = FFT_BACKEND, workers: int = FFT_WORKERS):
+    '''Select the FFT implementation, one of FFT_BACKENDS, and its threads. '''
+    global FFT_BACKEND, FFT_WORKERS
+    if backend not in FFT_BACKENDS:
+        raise ValueError(f'unknown FFT backend {backend}, choose from {FFT_BACKENDS}')
+    FFT_BACKEND = backend
+    FFT_WORKERS = workers
+
+
+def fft(x: ndarray, n: None | int = None) -> ndarray:
+    '''FFT of the last axis of x, in the precision of x. '''
+    if FFT_BACKEND == 'numpy':
+        return np.fft.fft(x, n=n)
+    return scipy.fft.fft(x, n=n, workers=FFT_WORKERS)
+
+
+def ifft(x: ndarray, n: None | int = None) -> ndarray:
+    if FFT_BACKEND == 'numpy':
+        return np.fft.ifft(x, n=n)
+    return scipy.fft.ifft(x, n=n, workers=FFT_WORKERS)
+
+
+@contextmanager
+def fft_workers():
+    '''Run the scipy.fft calls of other scipy functions (welch) on FFT_WORKERS threads. '''
+    with scipy.fft.set_workers(FFT_WORKERS):
+        yield
+
+
+@lru_cache
+def window_array(name: str, nperseg: int, dtype: type = np.float64) -> ndarray:
+    '''get_window(name, nperseg) as dtype, computed once, read-only. '''
+    win = get_window(name, nperseg).astype(dtype)
+    win.flags.writeable = False
+    return win
+
+
+@lru_cache
+def window_sums(name: str, nperseg: int) -> tuple[float, float]:
+    '''Sum and sum of squares of a window, the psd() and density() normalizations. '''
+    win = window_array(name, nperseg)
+    return win.sum(), (win * win).sum()
+
+
+def nperseg(nbins: int = NBINS, N_SEG_LIM: int = N_SEG_LIM) -> int:
+    return nbins if nbins < N_SEG_LIM else N_SEG_LIM
+
+
+def complex_itemsize(data: ndarray) -> int:
+    '''Bytes of a complex sample at the precision of data. '''
+    return np.result_type(data.dtype, np.complex64).itemsize
+
+
+def psd(iq: ndarray, nperseg: int, nfft: int, window: str = WINDOW) -> ndarray:
+    '''
+    Two-sided power spectrum of each row of iq (last axis), DC removed.
+
+    Same estimate as subtracting the row mean and calling
+    scipy.signal.welch(iq, nperseg=nperseg, nfft=nfft, noverlap=0,
+    scaling='spectrum', window=window, detrend=False,
+    return_onesided=False), in FFT order. Computed in the precision of iq,
+    complex64 or complex128.
+    '''
+    power = segment_power(iq, nperseg, nfft, window)
+    return power.mean(axis=-2) / window_sums(window, nperseg)[0]**2
+
+
+def segment_power(iq: ndarray, nperseg: int, nfft: int, window: str = WINDOW) -> ndarray:
+    '''Power spectra of the windowed segments of each row of iq, DC removed, (..., nseg, nfft). '''
+    iq = iq - iq.mean(axis=-1, keepdims=True)
+    nseg = iq.shape[-1] // nperseg
+    segments = iq[..., :nseg * nperseg].reshape(*iq.shape[:-1], nseg, nperseg)
+    win = window_array(window, nperseg, iq.real.dtype)
+    spectra = fft(segments * win, n=nfft)
+    return spectra.real**2 + spectra.imag**2
+
+
+def psd_sum(data: ndarray, nperseg: int, nfft: int, window: str = WINDOW,
+            batch_bytes: int = BATCH_BYTES) -> ndarray:
+    '''Sum (float64) of the psd() of the rows of data, a batch of rows per call. '''
+    nseg = max(data.shape[-1] // nperseg, 1)
+    batch = max(1, batch_bytes // (nseg * nfft * complex_itemsize(data)))
+    total = np.zeros(nfft)
+    for i in range(0, len(data), batch):
+        total += psd(data[i:i + batch], nperseg, nfft, window).sum(axis=0, dtype=np.float64)
+    return total
+
+
+def density(P: ndarray, sample_rate: float, nperseg: int, window: str = WINDOW) -> ndarray:
+    '''Convert a psd() power spectrum to a power spectral density (per Hz). '''
+    total, squares = window_sums(window, nperseg)
+    return P * (total**2 / squares) / sample_rate
+
+
+@lru_cache
+def pfb_coefficients(nchan: int, taps: int = PFB_TAPS, window: str = WINDOW) -> ndarray:
+    '''
+    Prototype low pass of a polyphase filterbank, (taps, nchan): a sinc one
+    channel wide over taps * nchan samples, windowed, read-only.
+    '''
+    M = taps * nchan
+    h = np.sinc((np.arange(M) - M / 2) / nchan) * get_window(window, M)
+    h = h.reshape(taps, nchan)
+    h.flags.writeable = False
+    return h
+
+
+@lru_cache
+def pfb_sums(nchan: int, taps: int = PFB_TAPS, window: str = WINDOW) -> tuple[float, float]:
+    '''Sum and sum of squares of pfb_coefficients, the pfb() and pfb_density() normalizations. '''
+    h = pfb_coefficients(nchan, taps, window)
+    return h.sum(), (h * h).sum()
+
+
+def pfb(iq: ndarray, nchan: int, taps: int = PFB_TAPS, window: str = WINDOW) -> ndarray:
+    '''
+    Polyphase filterbank power spectrum of each row of iq (last axis), DC
+    removed: nchan channels, the mean of the frames (one every nchan
+    samples) of the row, in FFT order.
+
+    Scaled like psd(), a tone at a channel centre reads as its power, so
+    frequencies(nchan) and pfb_density() apply. Each frame weights taps
+    blocks of nchan samples by pfb_coefficients and folds them before the
+    FFT, so a channel is nchan wide with taps times the stop band
+    attenuation of a windowed FFT of nchan samples.
+    '''
+    iq = iq - iq.mean(axis=-1, keepdims=True)
+    nframes = iq.shape[-1] // nchan - taps + 1
+    if nframes < 1:
+        raise ValueError(f'rows of {iq.shape[-1]} samples are shorter than the '
+                         f'{taps} x {nchan} filterbank')
+    blocks = iq[..., :(nframes + taps - 1) * nchan].reshape(
+            *iq.shape[:-1], nframes + taps - 1, nchan)
+    h = pfb_coefficients(nchan, taps, window).astype(iq.real.dtype)
+    frames = blocks[..., :nframes, :] * h[0]
+    for t in range(1, taps):
+        frames += blocks[..., t:t + nframes, :] * h[t]
+    spectra = fft(frames)
+    power = spectra.real**2 + spectra.imag**2
+    return power.mean(axis=-2) / pfb_sums(nchan, taps, window)[0]**2
+
+
+def pfb_sum(data: ndarray, nchan: int, taps: int = PFB_TAPS, window: str = WINDOW,
+            batch_bytes: int = BATCH_BYTES) -> ndarray:
+    '''Sum (float64) of the pfb() of the rows of data, a batch of rows per call. '''
+    batch = max(1, batch_bytes // (data.shape[-1] * complex_itemsize(data)))
+    total = np.zeros(nchan)
+    for i in range(0, len(data), batch):
+        total += pfb(data[i:i + batch], nchan, taps, window).sum(axis=0, dtype=np.float64)
+    return total
+
+
+def pfb_density(P: ndarray, sample_rate: float, nchan: int, taps: int = PFB_TAPS,
+                window: str = WINDOW) -> ndarray:
+    '''Convert a pfb() power spectrum to a power spectral density (per Hz). '''
+    total, squares = pfb_sums(nchan, taps, window)
+    return P * (total**2 / squares) / sample_rate
+
+
+def sk_sums(data: ndarray, nperseg: int, nfft: int, window: str = WINDOW,
+            batch_bytes: int = BATCH_BYTES) -> tuple[ndarray, ndarray, int]:
+    '''
+    Spectral kurtosis accumulators of each row of data: S1 and S2 (float64,
+    rows x nfft), the sums of the segment_power and of its square over the
+    M segments of the row, and M. S1 / M is the psd() of the row scaled by
+    window_sums()[0]**2.
+    '''
+    nseg = max(data.shape[-1] // nperseg, 1)
+    batch = max(1, batch_bytes // (nseg * nfft * complex_itemsize(data)))
+    S1 = np.empty((len(data), nfft))
+    S2 = np.empty((len(data), nfft))
+    for i in range(0, len(data), batch):
+        power = segment_power(data[i:i + batch], nperseg, nfft, window)
+        S1[i:i + batch] = power.sum(axis=-2, dtype=np.float64)
+        S2[i:i + batch] = (power * power).sum(axis=-2, dtype=np.float64)
+    return S1, S2, nseg
+
+
+def spectral_kurtosis(S1: ndarray, S2: ndarray, M: int) -> ndarray:
+    '''
+    Spectral kurtosis estimator of M power spectra (Nita & Gary 2010, d = 1),
+    1 for gaussian noise with a standard deviation of about 2 / sqrt(M).
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (M + 1) / (M - 1) * (M * S2 / S1**2 - 1)
+
+
+def bandpass(P: ndarray, channels: int = BANDPASS_CHANNELS) -> ndarray:
+    '''
+    Smooth bandpass of the rows of P: the median of each block of channels,
+    linearly interpolated between the block centres, so narrow features
+    stand out and the filter edges of the tuner do not.
+    '''
+    nfft = P.shape[-1]
+    block = int(np.gcd(nfft, channels))
+    medians = np.median(P.reshape(*P.shape[:-1], -1, block), axis=-1)
+    if medians.shape[-1] == 1:
+        return np.repeat(medians, nfft, axis=-1)
+    x = np.clip((np.arange(nfft) - (block - 1) / 2) / block, 0, medians.shape[-1] - 1)
+    i = np.minimum(x.astype(int), medians.shape[-1] - 2)
+    return medians[..., i] * (i + 1 - x) + medians[..., i + 1] * (x - i)
+
+
+def rfi_flags(S1: ndarray, S2: ndarray, M: int, sk_sigma: float = SK_SIGMA,
+              mad_sigma: float = MAD_SIGMA, channels: int = BANDPASS_CHANNELS) -> ndarray:
+    '''
+    RFI flags of the (row, channel) cells of sk_sums: the spectral kurtosis
+    more than sk_sigma standard deviations from 1 (non-gaussian, e.g.
+    intermittent or steady carriers), or the power of the row more than
+    mad_sigma robust standard deviations (1.4826 MAD over the channels of
+    the row) above its bandpass().
+    '''
+    # cells of no power (nan) are left unflagged
+    flags = np.abs(spectral_kurtosis(S1, S2, M) - 1) > sk_sigma * 2 / np.sqrt(M)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = S1 / bandpass(S1, channels)
+    median = np.median(ratio, axis=-1, keepdims=True)
+    mad = 1.4826 * np.median(np.abs(ratio - median), axis=-1, keepdims=True)
+    flags |= ratio - median > mad_sigma * mad
+    # the DC bin is emptied by the mean removal
+    flags[..., 0] = False
+    return flags
+
+
+def frequencies(nfft: int, sample_rate: float) -> ndarray:
+    '''Baseband frequencies of psd() bins, in FFT order. '''
+    return np.fft.fftfreq(nfft, 1 / sample_rate)
+
+
+def acf_nfft(width: int, max_lag: int) -> int:
+    '''FFT length giving lags 0..max_lag of rows of width samples without wrap around. '''
+    return next_fast_len(width + max_lag)
+
+
+def acf_power_sum(data: ndarray, nfft: int, batch_bytes: int = BATCH_BYTES) -> ndarray:
+    '''
+    Sum (float64) of the power spectra (nfft zero padded) of the rows of
+    data, each row normalized to unit energy, so acf() of their mean is the
+    mean normalized autocorrelation function.
+    '''
+    batch = max(1, batch_bytes // (nfft * complex_itemsize(data)))
+    total = np.zeros(nfft)
+    for i in range(0, len(data), batch):
+        spectra = fft(data[i:i + batch], n=nfft)
+        power = spectra.real**2 + spectra.imag**2
+        # the zero lag, sum(abs(x)**2), is power.sum() / nfft (Parseval)
+        total += (power / power.sum(axis=-1, keepdims=True, dtype=np.float64)).sum(axis=0)
+    return total * nfft
+
+
+def acf(P: ndarray, max_lag: int) -> ndarray:
+    '''Autocorrelation function, lags 0..max_lag, of a power spectrum (Wiener-Khinchin). '''
+    return ifft(P)[:max_lag + 1]
+
+
+class Spectrometer:
+    '''
+    Running sum of the psd() of rows from one channel.
+
+    Optionally also sums the rows since the last dump(), for per-N-row
+    spectra of long integrations. Cells flagged as RFI are left out of the
+    sums, so each channel counts its own rows.
+    '''
+
+    def __init__(self, nbins: int = NBINS, N_SEG_LIM: int = N_SEG_LIM,
+                 window: str = WINDOW):
+        self.nbins = nbins
+        self.nperseg = nperseg(nbins, N_SEG_LIM)
+        self.window = window
+        self.total = np.zeros(nbins)
+        self.counts = np.zeros(nbins)
+        self.rows = 0
+        self.block = np.zeros(nbins)
+        self.block_counts = np.zeros(nbins)
+        self.block_rows = 0
+
+    def psd(self, iq: ndarray) -> ndarray:
+        return psd(iq, self.nperseg, self.nbins, self.window)
+
+    def flagged_psd(self, iq: ndarray, sk_sigma: float = SK_SIGMA,
+                    mad_sigma: float = MAD_SIGMA) -> tuple[ndarray, ndarray]:
+        '''psd() of a row and its rfi_flags(). '''
+        S1, S2, M = sk_sums(iq[np.newaxis], self.nperseg, self.nbins, self.window)
+        P = S1[0] / (M * window_sums(self.window, self.nperseg)[0]**2)
+        return P, rfi_flags(S1, S2, M, sk_sigma, mad_sigma)[0]
+
+    def add(self, iq: ndarray):
+        '''Accumulate a row, or a (rows, samples) block. '''
+        P = self.psd(iq)
+        if P.ndim > 1:
+            self.add_power(P.sum(axis=0), len(P))
+        else:
+            self.add_power(P)
+
+    def add_power(self, P: ndarray, rows: int = 1, flags: None | ndarray = None):
+        '''
+        Accumulate the sum of the psd() of rows rows, or the psd() of one row
+        without its channels flagged (rfi_flags()).
+        '''
+        counts = rows
+        if flags is not None:
+            P = np.where(flags, 0, P)
+            counts = ~flags
+        self.total += P
+        self.counts += counts
+        self.rows += rows
+        self.block += P
+        self.block_counts += counts
+        self.block_rows += rows
+
+    def mean(self) -> ndarray:
+        '''Mean of the rows, nan in channels flagged in every row. '''
+        return masked_mean(self.total, self.counts, self.rows)
+
+    def dump(self) -> ndarray:
+        '''Mean of the rows added since the previous dump. '''
+        P = masked_mean(self.block, self.block_counts, self.block_rows)
+        self.block = np.zeros(self.nbins)
+        self.block_counts = np.zeros(self.nbins)
+        self.block_rows = 0
+        return P
+
+
+def masked_mean(total: ndarray, counts: ndarray, rows: int) -> ndarray:
+    '''total / counts, nan where a channel counts nothing out of rows > 0. '''
+    if not rows:
+        return total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, total / counts, np.nan)
+
+
+def stage_factors(factor: int) -> list[int]:
+    '''Split a decimation factor into stages of at most MAX_STAGE, largest first. '''
+    stages = []
+    while factor > 1:
+        q = next((q for q in range(MAX_STAGE, 1, -1) if factor % q == 0), None)
+        if q is None:
+            raise ValueError(f'decimation {factor} has a prime factor above {MAX_STAGE}')
+        stages.append(q)
+        factor //= q
+    return stages
+
+
+class Decimator:
+    '''
+    Streaming decimation of the rows of blocks along the last axis, by
+    factor in stages of at most MAX_STAGE.
+
+    Each stage is the order 8 Chebyshev type I anti-aliasing low pass of
+    scipy.signal.decimate, run forward with its state, and the sample phase,
+    carried from one block to the next, so the blocks decimate as one series.
+    The filters start in their steady state for the mean of the first
+    WARMUP samples.
+    '''
+
+    def __init__(self, factor: int):
+        self.factor = factor
+        self.stages = [{'q': q, 'sos': cheby1(8, 0.05, 0.8 / q, output='sos'),
+                        'zi': None, 'offset': 0}
+                       for q in stage_factors(factor)]
+
+    def __call__(self, x: ndarray) -> ndarray:
+        if self.stages and self.stages[0]['zi'] is None:
+            # (near) unit gain at DC, every stage settles to about the same level
+            level = x[..., :WARMUP].mean(axis=-1, keepdims=True)
+            for stage in self.stages:
+                zi = sosfilt_zi(stage['sos'])
+                # (sections, *x.shape[:-1], 2)
+                stage['zi'] = zi.reshape(zi.shape[0], *[1] * (x.ndim - 1), 2) * level
+        for stage in self.stages:
+            y, stage['zi'] = sosfilt(stage['sos'], x, axis=-1, zi=stage['zi'])
+            # keep the samples at multiples of q of the whole series
+            x = y[..., (-stage['offset']) % stage['q']::stage['q']]
+            stage['offset'] += y.shape[-1]
+        return x
+
+
+class DDC:
+    '''
+    Digital downconversion of a stream of rows: shift offset (Hz) to 0 Hz,
+    low pass (windowed FIR, passing DDC_PASSBAND of the new Nyquist band)
+    and decimate by factor.
+
+    The oscillator phase and the FIR history carry from row to row, so the
+    rows convert as one series and each row of a multiple of factor samples
+    gives width / factor samples. The series starts from zeros, reset()
+    restarts it after a gap. Output is complex64 for complex64 input.
+    '''
+
+    def __init__(self, sample_rate: float, offset: float, factor: int, taps: int = DDC_TAPS):
+        self.sample_rate = sample_rate
+        self.offset = offset
+        self.factor = factor
+        self.h = (firwin(taps * factor + 1, DDC_PASSBAND / factor) if factor > 1
+                  else np.ones(1))
+        self.oscillators = dict()  # by row length, exp(-2 pi i offset t) from phase 0
+        self.phase = 0.  # cycles of the oscillator at the next sample, mod 1
+        self.reset()
+
+    @property
+    def band(self) -> tuple[float, float]:
+        '''Edges of the passband, Hz from the tuned frequency. '''
+        half = DDC_PASSBAND * self.sample_rate / self.factor / 2
+        return self.offset - half, self.offset + half
+
+    def reset(self):
+        '''Restart the series (the FIR history), the oscillator runs on. '''
+        L = len(self.h) - 1
+        # history starts at a multiple of factor so upfirdn's phase is the series'
+        self.history = np.zeros(-(-L // self.factor) * self.factor, dtype=np.complex64)
+        self.n = 0  # samples since the reset
+
+    def oscillator(self, length: int) -> ndarray:
+        if length not in self.oscillators:
+            t = np.arange(length) / self.sample_rate
+            self.oscillators[length] = np.exp(-2j * np.pi * self.offset * t)
+        return self.oscillators[length]
+
+    def __call__(self, x: ndarray) -> ndarray:
+        mixed = x * (self.oscillator(len(x)) * np.exp(2j * np.pi * self.phase)).astype(x.dtype)
+        self.phase = (self.phase - self.offset * len(x) / self.sample_rate) % 1
+        full = np.concatenate((self.history.astype(mixed.dtype), mixed))
+        start = self.n - len(self.history)  # series index of full[0], a multiple of factor
+        # outputs at the multiples of factor in this row
+        first = -(-(self.n - start) // self.factor)
+        last = (self.n + len(x) - 1 - start) // self.factor + 1
+        y = upfirdn(self.h.astype(x.real.dtype), full, down=self.factor)[first:last]
+        self.n += len(x)
+        L = len(self.h) - 1
+        self.history = full[len(full) - (L + (self.n - L) % self.factor):]
+        return y
+
+
+class Moments:
+    '''
+    Count, mean and central moments (2 to 4) of a stream of blocks, merged
+    block by block (Pebay 2008) so precision holds over long streams.
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.M2 = self.M3 = self.M4 = 0.
+
+    def update(self, x: ndarray):
+        x = np.asarray(x, dtype=np.float64).ravel()
+        n_b = x.size
+        if n_b == 0:
+            return
+        mean_b = x.mean()
+        d = x - mean_b
+        d2 = d * d
+        M2_b, M3_b, M4_b = d2.sum(), (d2 * d).sum(), (d2 * d2).sum()
+
+        n_a, M2_a, M3_a = self.n, self.M2, self.M3
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        self.M4 += (M4_b + delta**4 * n_a * n_b * (n_a**2 - n_a * n_b + n_b**2) / n**3
+                    + 6 * delta**2 * (n_a**2 * M2_b + n_b**2 * M2_a) / n**2
+                    + 4 * delta * (n_a * M3_b - n_b * M3_a) / n)
+        self.M3 += (M3_b + delta**3 * n_a * n_b * (n_a - n_b) / n**2
+                    + 3 * delta * (n_a * M2_b - n_b * M2_a) / n)
+        self.M2 += M2_b + delta**2 * n_a * n_b / n
+        self.mean += delta * n_b / n
+        self.n = n
+
+    @property
+    def variance(self) -> float:
+        return self.M2 / self.n
+
+    @property
+    def kurtosis(self) -> float:
+        '''Excess (Fisher) kurtosis, 0 for a normal distribution. '''
+        return self.n * self.M4 / self.M2**2 - 3
@@ -0,0 +1,159 @@
+'''
+Simulated RtlSdr for exercising collect.py without the dongles.
+
+Produces deterministic gaussian noise (seeded by serial number and the
+times it was opened) plus an optional HI line, only on the signal dongle
+by default (line_amplitudes), paced to the configured sample rate, and
+can inject USB errors. Like the dongle, sync reads lose the samples of
+the time between them, async reads queue up to ASYNC_BUFFERS transfers
+behind a slow callback and lose the ones beyond, and a failed sync read
+closes the device as pyrtlsdr does. install() makes `from rtlsdr import RtlSdr` resolve to FakeRtlSdr:
+
+>>> import fake_rtlsdr
+>>> fake_rtlsdr.install(error_rate=0.01)
+>>> import collect
+'''
+from collections import Counter
+from time import perf_counter, sleep
+from zlib import crc32
+import logging
+import sys
+import types
+import numpy as np
+from numpy import ndarray
+
+
+LOGGER = logging.getLogger(__name__)
+ASYNC_BUFFERS = 15  # transfers queued by rtlsdr_read_async, librtlsdr's default buf_num
+OPENS = Counter()   # times each serial number was opened, seeds a reopened device anew
+
+
+class FakeRtlSdr:
+    # simulation knobs, set per class with install(**options)
+    line_freq: float = 1420.4057e6  # Hz, frequency of the injected line
+    line_amplitude: float = 4.      # ADC counts, 0 disables the line
+    # per serial number line_amplitude, the reference dongle (collect.ConfTelescope.reference_sn)
+    # sits on a 50 ohm termination and sees no sky
+    line_amplitudes: dict = {'00000011': 0.}
+    noise: float = 8.               # ADC counts, standard deviation of I and Q
+    error_rate: float = 0.          # probability of a read raising IOError
+    realtime: bool = True           # pace reads to the sample rate
+
+    def __init__(self, serial_number: str = '00000001'):
+        self.serial_number = serial_number
+        self.line_amplitude = self.line_amplitudes.get(serial_number, self.line_amplitude)
+        self.rng = np.random.default_rng([crc32(serial_number.encode()), OPENS[serial_number]])
+        OPENS[serial_number] += 1
+        self.center_freq = 1420.4e6
+        self.sample_rate = 2.85e6
+        self.gain = 0
+        self.samples = 0       # samples delivered since the clock started
+        self.clock = None      # perf_counter() at the first read
+        self.read_async_canceling = False
+        self.device_opened = True
+        LOGGER.info(f'opened simulated RTL-SDR {serial_number=}')
+
+    def get_center_freq(self) -> float:
+        return self.center_freq
+
+    def get_sample_rate(self) -> float:
+        return self.sample_rate
+
+    def get_gain(self) -> float:
+        return self.gain
+
+    def get_bandwidth(self) -> float:
+        return 0
+
+    def close(self):
+        self.device_opened = False
+        LOGGER.info(f'closed simulated RTL-SDR {self.serial_number=}')
+
+    def _generate(self, num_samples: int) -> ndarray:
+        iq = self.rng.normal(0, self.noise, 2 * num_samples)
+        offset = self.line_freq - self.center_freq
+        if self.line_amplitude and abs(offset) < self.sample_rate / 2:
+            t = (self.samples + np.arange(num_samples)) / self.sample_rate
+            line = self.line_amplitude * np.exp(2j * np.pi * offset * t)
+            iq[0::2] += line.real
+            iq[1::2] += line.imag
+        return (iq + 127.5).round().clip(0, 255).astype(np.uint8)
+
+    def _start(self):
+        '''Start the sample clock, or drop the samples since the last read returned. '''
+        if self.clock is None:
+            self.clock = perf_counter()
+        lag = perf_counter() - self.clock - self.samples / self.sample_rate
+        if self.realtime and lag > 0:
+            # nobody was reading, like the dongle those samples are gone
+            self.samples += int(lag * self.sample_rate)
+
+    def _capture(self, num_samples: int) -> ndarray:
+        '''The next num_samples, returned once the sample clock has reached their end. '''
+        raw = self._generate(num_samples)
+        self.samples += num_samples
+        if self.realtime:
+            delay = self.clock + self.samples / self.sample_rate - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        return raw
+
+    def _error(self) -> bool:
+        return bool(self.error_rate) and self.rng.random() < self.error_rate
+
+    def read_bytes(self, num_bytes: int):
+        if not self.device_opened:
+            raise IOError(f'simulated RTL-SDR {self.serial_number} is closed')
+        self._start()
+        raw = self._capture(int(num_bytes) // 2)
+        if self._error():
+            # pyrtlsdr closes the device on a short read
+            self.close()
+            raise IOError(f'Short read, requested {num_bytes} bytes, received 0')
+        return np.ctypeslib.as_ctypes(raw)
+
+    def packed_bytes_to_iq(self, bytes) -> ndarray:
+        iq = np.ctypeslib.as_array(bytes).astype(np.float64).view(np.complex128)
+        iq /= 127.5
+        iq -= (1 + 1j)
+        return iq
+
+    def read_samples(self, num_samples: int) -> ndarray:
+        return self.packed_bytes_to_iq(self.read_bytes(2 * num_samples))
+
+    def read_bytes_async(self, callback, num_bytes: int, context=None):
+        if not self.device_opened:
+            raise IOError(f'simulated RTL-SDR {self.serial_number} is closed')
+        num_samples = int(num_bytes) // 2
+        self.read_async_canceling = False
+        self._start()
+        while not self.read_async_canceling:
+            if self.realtime:
+                # transfers completed while the callback ran wait in the
+                # queue, the oldest are overwritten beyond ASYNC_BUFFERS
+                queued = int((perf_counter() - self.clock) * self.sample_rate - self.samples) // num_samples
+                if queued > ASYNC_BUFFERS:
+                    self.samples += (queued - ASYNC_BUFFERS) * num_samples
+            raw = self._capture(num_samples)
+            if self._error():
+                # a failed transfer is lost, the stream carries on
+                LOGGER.debug(f'transfer of {num_bytes} bytes failed')
+                continue
+            if not self.read_async_canceling:
+                callback(np.ctypeslib.as_ctypes(raw), context or self)
+
+    def cancel_read_async(self):
+        self.read_async_canceling = True
+
+
+def install(**options):
+    '''Register FakeRtlSdr as rtlsdr.RtlSdr, options set its simulation knobs. '''
+    for key, value in options.items():
+        if not hasattr(FakeRtlSdr, key):
+            raise ValueError(f'unknown FakeRtlSdr option {key}')
+        setattr(FakeRtlSdr, key, value)
+    module = types.ModuleType('rtlsdr')
+    module.RtlSdr = FakeRtlSdr
+    sys.modules['rtlsdr'] = module
+    if 'collect' in sys.modules:
+        sys.modules['collect'].RtlSdr = FakeRtlSdr
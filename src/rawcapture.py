@@ -0,0 +1,269 @@
+'''
+Memory mapped raw capture format, collect.py --memmap.
+
+A capture is a directory of flat, preallocated files of interleaved uint8
+IQ rows, one per group and channel, written by sequential appends, and a
+capture.json sidecar holding the file and group attrs, the dataset attrs
+and the small per row datasets (valid flags, times). Nothing is compressed
+or chunked, so the capture loop spends no CPU on the file format.
+
+reduce.py reads the rows in place with numpy.memmap, open_capture() opens
+either format. convert() rewrites a capture as the HDF5 data/{i}/IQ layout
+of collect.py, off the telescope:
+
+$ python rawcapture.py data/20261018.1200.raw --compression gzip-5
+'''
+from pathlib import Path
+import json
+import logging
+import os
+import numpy as np
+from numpy import ndarray
+import h5py
+
+from compression import DEFAULT_CODEC, CODECS, codec
+
+
+LOGGER = logging.getLogger(__name__)
+SUFFIX = '.raw'  # of a capture directory
+SIDECAR = 'capture.json'
+VERSION = 1  # of the sidecar layout
+BLOCK_BYTES = 2**26  # rows copied at a time by convert()
+
+
+def jsonable(value):
+    '''An attrs value as JSON, numpy scalars and arrays as Python. '''
+    if isinstance(value, np.ndarray | np.generic):
+        return value.tolist()
+    if isinstance(value, list | tuple):
+        return [jsonable(v) for v in value]
+    return value
+
+
+def attrs_from_json(attrs: dict) -> dict:
+    '''Lists back to arrays, as h5py reads them. '''
+    return {key: np.asarray(val) if isinstance(val, list) else val
+            for key, val in attrs.items()}
+
+
+def is_capture(path: Path | str) -> bool:
+    return (Path(path) / SIDECAR).is_file()
+
+
+def open_capture(path: Path | str):
+    '''Open a capture directory or an HDF5 file read-only. '''
+    return Capture(path) if is_capture(path) else h5py.File(path, 'r')
+
+
+class RowAppender:
+    '''
+    Preallocated flat file of rows x width uint8, written by sequential
+    appends of one row at a time.
+
+    Supports the buffer[i] = row assignment of SDR.integrateN/streamN like
+    collect.RowWriter. A row lost to an IOError keeps its place, zero
+    filled by the preallocation. The file is unbuffered, a row is on disk
+    once its assignment returns.
+    '''
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, fname: Path, rows: int, width: int):
+        self.file = open(fname, 'wb', buffering=0)
+        self.width = width
+        self.rows = 0  # the next row is appended at rows * width
+        if rows and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, rows * width)
+        else:
+            self.file.truncate(rows * width)
+
+    def __len__(self):
+        return self.rows
+
+    def __setitem__(self, i: int, row: ndarray):
+        if i != self.rows:
+            self.file.seek(i * self.width)
+        self.file.write(np.ascontiguousarray(row, dtype=np.uint8).data)
+        self.rows = i + 1
+
+    def close(self):
+        self.file.close()
+
+
+class Dataset:
+    '''Rows of a capture file through numpy.memmap, read like an h5py.Dataset. '''
+    chunks = None
+
+    def __init__(self, fname: Path, shape: list[int], dtype: str, attrs: dict):
+        shape = tuple(shape)
+        if np.prod(shape):
+            self.array = np.memmap(fname, dtype=dtype, mode='r', shape=shape)
+        else:
+            self.array = np.empty(shape, dtype=dtype)
+        self.attrs = attrs_from_json(attrs)
+
+    @property
+    def shape(self) -> tuple:
+        return self.array.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.array.dtype
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index) -> ndarray:
+        # a view of the mapping for slices, a copy for index arrays
+        return np.asarray(self.array[index])
+
+
+class Group:
+    '''A group of a capture, its attrs and datasets by name like an h5py.Group. '''
+
+    def __init__(self, capture: 'Capture', name: str, meta: dict):
+        self.capture = capture
+        self.name = f'/{name}'
+        self.meta = meta
+        self.attrs = meta['attrs'] if capture.writable else attrs_from_json(meta['attrs'])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.meta['datasets']
+
+    def __iter__(self):
+        return iter(self.meta['datasets'])
+
+    def __getitem__(self, name: str) -> ndarray | Dataset:
+        meta = self.meta['datasets'][name]
+        if 'file' in meta:
+            return Dataset(self.capture.path / meta['file'], meta['shape'],
+                           meta['dtype'], meta['attrs'])
+        return np.asarray(meta['data'], dtype=meta['dtype'])
+
+    def create_dataset(self, name: str, data: ndarray):
+        '''Store a small dataset (per row flags and times) in the sidecar. '''
+        data = np.asarray(data)
+        self.meta['datasets'][name] = {'data': data.tolist(), 'dtype': data.dtype.str}
+
+    def create_rows(self, name: str, rows: int, width: int, attrs: dict) -> RowAppender:
+        '''Preallocate the rows x width uint8 file of dataset name. '''
+        fname = f'{self.name.strip("/").replace("/", "-")}-{name}.bin'
+        self.meta['datasets'][name] = {'file': fname, 'shape': [rows, width],
+                                       'dtype': 'uint8', 'attrs': dict(attrs)}
+        writer = RowAppender(self.capture.path / fname, rows, width)
+        self.capture.writers.append(writer)
+        return writer
+
+
+class Capture:
+    '''
+    A capture directory, opened read-only or written (mode 'w') like an
+    h5py.File: attrs, create_group('data/{i}') and file['data/{i}'].
+
+    The sidecar is rewritten as each group is created and on close, so the
+    groups finished before a capture dies stay readable.
+    '''
+
+    def __init__(self, path: Path | str, mode: str = 'r'):
+        self.path = Path(path)
+        self.writable = mode == 'w'
+        self.writers = []
+        if self.writable:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.meta = {'version': VERSION, 'attrs': dict(), 'groups': dict()}
+            self.attrs = self.meta['attrs']
+        else:
+            with open(self.path / SIDECAR) as sidecar:
+                self.meta = json.load(sidecar)
+            if self.meta['version'] > VERSION:
+                raise ValueError(f'{self.path} is a version {self.meta["version"]} capture, '
+                                 f'this reader knows up to {VERSION}')
+            self.attrs = attrs_from_json(self.meta['attrs'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name: str) -> bool:
+        return name.strip('/') in self.meta['groups']
+
+    def __getitem__(self, name: str) -> Group | dict:
+        '''A group, or the groups under name (file['data']) by their last name. '''
+        name = name.strip('/')
+        if name in self.meta['groups']:
+            return Group(self, name, self.meta['groups'][name])
+        prefix = f'{name}/'
+        return {group[len(prefix):]: self[group] for group in self.meta['groups']
+                if group.startswith(prefix)}
+
+    def groups(self) -> list[str]:
+        return list(self.meta['groups'])
+
+    def create_group(self, name: str) -> Group:
+        self.flush()
+        self.meta['groups'][name] = {'attrs': dict(), 'datasets': dict()}
+        return Group(self, name, self.meta['groups'][name])
+
+    def flush(self):
+        '''Atomically rewrite the sidecar. '''
+        if not self.writable:
+            return
+        tmp = self.path / f'{SIDECAR}.tmp'
+        with open(tmp, 'w') as sidecar:
+            json.dump(self.meta, sidecar, default=jsonable, indent=1)
+        os.replace(tmp, self.path / SIDECAR)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.writers.clear()
+        self.flush()
+
+
+def convert(path: Path | str, fname: Path | str, compression: str = DEFAULT_CODEC,
+            block_bytes: int = BLOCK_BYTES):
+    '''
+    Rewrite the capture at path as the HDF5 file fname, in the layout and
+    with the row chunks collect.py writes, rows compressed with compression.
+    '''
+    codec_kwargs = codec(compression)
+    with Capture(path) as capture, h5py.File(fname, 'w') as file:
+        file.attrs.update(capture.attrs)
+        file.attrs['compression'] = compression
+        for name in capture.groups():
+            group = capture[name]
+            out = file.create_group(name)
+            out.attrs.update(group.attrs)
+            for dataset_name in group:
+                dataset = group[dataset_name]
+                if not isinstance(dataset, Dataset):
+                    out.create_dataset(dataset_name, data=dataset)
+                    continue
+                rows, width = dataset.shape
+                copy = out.create_dataset(dataset_name, shape=dataset.shape, dtype=dataset.dtype,
+                                          chunks=(1, width) if rows else None,
+                                          **codec_kwargs)
+                copy.attrs.update(dataset.attrs)
+                block = max(1, block_bytes // max(width, 1))
+                for i in range(0, rows, block):
+                    copy[i:i + block] = dataset[i:i + block]
+            LOGGER.info(f'converted {name}')
+    LOGGER.info(f'wrote {fname}')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser(description='convert a memmap capture to HDF5')
+    parser.add_argument('capture', type=Path, help='capture directory written by collect.py --memmap')
+    parser.add_argument('--output', '-o', default=None, type=Path,
+                        help='HDF5 file to write, default the capture path with the suffix .h5')
+    parser.add_argument('--compression', '-c', default=DEFAULT_CODEC,
+                        help=f'dataset codec, one of {CODECS}, default {DEFAULT_CODEC}')
+
+    args = parser.parse_args()
+    if not is_capture(args.capture):
+        parser.error(f'{args.capture} holds no {SIDECAR}')
+    convert(args.capture, args.output or args.capture.with_suffix('.h5'), args.compression)
@@ -3,10 +3,18 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import ndarray, array
-from scipy.signal import welch, get_window, correlate, lfilter
+from dataclasses import dataclass, field
+from contextlib import nullcontext
+from typing import Callable
+from multiprocessing import get_context
+from scipy.signal import welch, get_window, lfilter, lfilter_zi
 import logging
 # from fpdf import FPDF
 import h5py
+import compression  # registers the hdf5plugin filters when available
+import dsp
+import cache
+import rawcapture
 # from PIL import Image
 
 
@@ -17,13 +25,250 @@ logging.getLogger('PIL').setLevel(logging.WARNING)
 LOGGER = logging.getLogger(__name__)
 # FIG_SIZE = (25, 8)
 FIG_SIZE = (18, 8)
+MAX_MEMORY = 512  # MB, default memory ceiling of a streamed reduction
+BATCH_SHARE = 0.25  # of the memory ceiling for the FFT batches of the dsp engines
+BATCH_PEAK = 4    # peak working memory of a dsp engine batch, in batch_bytes
+# complex copies of a row held by each shared Chunk product (power and
+# magnitude are real, three channels, the sk_sums spectra are negligible)
+PRODUCT_COPIES = {'corrected': 1., 'power': 1.5, 'magnitude': 1.5, 'sk_sums': 0.}
+RAW_ENCODINGS = ('uint8-interleaved', 'int16-interleaved')  # converted by iq_from_raw
+PRECISIONS = {'single': np.complex64, 'double': np.complex128}  # --precision of the reducers
+DECIMATION = 10000  # radiometer time series decimation, 2.4 MHz to 240 Hz
+HIST_BINS = 361  # magnitude histogram bins, fixed so groups and files compare
+HIST_MAX = HIST_BINS / 127.5  # an ADC code per bin, up to full scale signal - reference, 2 sqrt(2)
+HIST_TIE = 1e-4  # of a bin, below the closest approach of an ADC magnitude to an edge
+CLIP_LEVEL = 1 - 0.5 / 127.5  # normed I or Q beyond this is an ADC code 0 or 255
+HEADLESS = False  # set by headless()
+ENVELOPE = True  # plot long lines as min/max envelopes of the pixel columns
+FIGURES = dict()  # headless figures by plot, reused between groups
+
+
+def is_raw(dataset) -> bool:
+    '''True if dataset holds interleaved integer IQ (collect --raw, uint8, or --ddc, int16). '''
+    return dataset.attrs.get('encoding', '') in RAW_ENCODINGS
+
+
+def iq_from_raw(raw: ndarray, attrs, dtype: type = np.complex64) -> ndarray:
+    '''Convert rows of interleaved integer IQ to complex samples of dtype. '''
+    real = np.empty(0, dtype=dtype).real.dtype
+    iq = raw.astype(real).view(dtype)
+    iq -= real.type(attrs['dc_offset']) * (1 + 1j)
+    iq *= real.type(attrs['scale'])
+    return iq
+
+
+def valid_rows(group, start: int = 1) -> ndarray:
+    '''
+    Indices of the rows [start:] of a group captured on both channels.
+
+    Rows flagged in the IQ_valid / reference_valid masks written by
+    collect.py are skipped, groups without masks are taken as all valid.
+    '''
+    rows = min(len(group['IQ']), len(group['reference']))
+    valid = np.ones(rows, dtype=bool)
+    valid[:start] = False
+    for name in ('IQ', 'reference'):
+        if f'{name}_valid' in group:
+            mask = group[f'{name}_valid'][:rows]
+            valid[:len(mask)] &= mask
+    skipped = rows - start - valid.sum()
+    if skipped > 0:
+        LOGGER.warning(f'skipping {skipped} invalid rows of {group.name}')
+    return np.flatnonzero(valid)
+
+
+def read_rows(dataset, index: ndarray, dtype: None | type = None) -> ndarray:
+    '''
+    Read the rows index (increasing) of dataset as complex samples, of dtype
+    if given (complex64 for raw datasets otherwise).
+    '''
+    if len(index) and index[-1] - index[0] + 1 == len(index):
+        block = dataset[index[0]:index[-1] + 1]
+    else:
+        block = dataset[index]
+    if is_raw(dataset):
+        return iq_from_raw(block, dataset.attrs, dtype or np.complex64)
+    return block if dtype is None else block.astype(dtype, copy=False)
+
+
+def batch_bytes(max_memory: float = MAX_MEMORY) -> int:
+    '''batch_bytes of the dsp engines, their share (BATCH_SHARE) of max_memory MB. '''
+    return max(1, int(max_memory * 2**20 * BATCH_SHARE / BATCH_PEAK))
+
+
+def chunk_rows(group, max_memory: float = MAX_MEMORY, dtype: type = np.complex128,
+               names: None | list[str] = None) -> int:
+    '''
+    Rows per chunk of a streamed reduction of group at the precision dtype by
+    the reducers names (default all).
+
+    A chunk of both channels, the shared products and the largest
+    temporaries of the reducers (Reducer.products, Reducer.temporaries)
+    stays within the max_memory MB left by the dsp engine batches, rounded
+    down to a multiple of the HDF5 chunk rows when that many fit.
+    '''
+    dataset = group['IQ']
+    width = dataset.shape[1] // 2 if is_raw(dataset) else dataset.shape[1]
+    reducers = [REDUCERS[name] for name in names or REDUCERS]
+    products = {product for reducer in reducers for product in reducer.products}
+    copies = 2 + sum(PRODUCT_COPIES[product] for product in products)
+    temporaries = max(reducer.temporaries for reducer in reducers)
+    row = width * (np.dtype(dtype).itemsize * copies + temporaries)
+    rows = max(1, int(max_memory * 2**20 * (1 - BATCH_SHARE) // row))
+    if dataset.chunks and rows >= dataset.chunks[0]:
+        rows -= rows % dataset.chunks[0]
+    return rows
+
+
+class Chunk:
+    '''
+    Rows of both channels, read once per pass, and the products derived from
+    them. A product is computed on first use and shared by every accumulator
+    the chunk is fed to. The dsp engines work in batches of batch_bytes.
+
+    With sk_sums (a reducer uses them), psd_sum is derived from the sk_sums
+    instead of transforming the same segments again.
+    '''
+
+    def __init__(self, signal: ndarray, reference: ndarray, batch_bytes: int = dsp.BATCH_BYTES,
+                 sk_sums: bool = False):
+        self.signal = signal
+        self.reference = reference
+        self.batch_bytes = batch_bytes
+        self.shared_sk_sums = sk_sums
+        self.products = dict()
+
+    def __len__(self) -> int:
+        return len(self.signal)
+
+    def product(self, key: tuple, fn: Callable, *args) -> ndarray:
+        if key not in self.products:
+            self.products[key] = fn(*args)
+        return self.products[key]
+
+    @property
+    def corrected(self) -> ndarray:
+        '''signal - reference'''
+        return self.product(('corrected',), np.subtract, self.signal, self.reference)
+
+    def channels(self) -> tuple[ndarray, ndarray, ndarray]:
+        return self.signal, self.reference, self.corrected
+
+    def power(self, channel: str) -> ndarray:
+        '''Detected power, abs(x)**2, of the rows of channel. '''
+        return self.product(('power', channel), lambda x: np.abs(x) ** 2,
+                            getattr(self, channel))
+
+    def magnitude(self, channel: str) -> ndarray:
+        '''abs(x) of the rows of channel. '''
+        return self.product(('magnitude', channel), np.sqrt, self.power(channel))
+
+    def acf_power_sum(self, channel: str, nfft: int) -> ndarray:
+        '''dsp.acf_power_sum of the rows of channel. '''
+        return self.product(('acf_power_sum', channel, nfft), dsp.acf_power_sum,
+                            getattr(self, channel), nfft, self.batch_bytes)
+
+    def pfb_sum(self, channel: str, nchan: int, taps: int,
+                window: str = dsp.WINDOW) -> ndarray:
+        '''dsp.pfb_sum of the rows of channel. '''
+        return self.product(('pfb_sum', channel, nchan, taps, window), dsp.pfb_sum,
+                            getattr(self, channel), nchan, taps, window, self.batch_bytes)
+
+    def psd_sum(self, channel: str, nperseg: int, nfft: int,
+                window: str = dsp.WINDOW) -> ndarray:
+        '''dsp.psd_sum of the rows of channel. '''
+        if self.shared_sk_sums:
+            S1, _, M = self.sk_sums(channel, nperseg, nfft, window)
+            return S1.sum(axis=0) / (M * dsp.window_sums(window, nperseg)[0]**2)
+        return self.product(('psd_sum', channel, nperseg, nfft, window), dsp.psd_sum,
+                            getattr(self, channel), nperseg, nfft, window, self.batch_bytes)
+
+    def sk_sums(self, channel: str, nperseg: int, nfft: int,
+                window: str = dsp.WINDOW) -> tuple[ndarray, ndarray, int]:
+        '''dsp.sk_sums of the rows of channel. '''
+        return self.product(('sk_sums', channel, nperseg, nfft, window), dsp.sk_sums,
+                            getattr(self, channel), nperseg, nfft, window, self.batch_bytes)
+
+
+def iter_chunks(group, rows: ndarray, max_memory: float = MAX_MEMORY,
+                dtype: type = np.complex128, names: None | list[str] = None):
+    '''Yield Chunks of the rows (indices) of group, samples of dtype, sized for the reducers names. '''
+    n = chunk_rows(group, max_memory, dtype, names)
+    sk_sums = any('sk_sums' in REDUCERS[name].products for name in names or REDUCERS)
+    for i in range(0, len(rows), n):
+        index = rows[i:i + n]
+        yield Chunk(read_rows(group['IQ'], index, dtype),
+                    read_rows(group['reference'], index, dtype), batch_bytes(max_memory), sk_sums)
+
+
+def headless():
+    '''Render with the non-interactive Agg backend, reusing figures between groups. '''
+    global HEADLESS
+    if not HEADLESS:
+        plt.switch_backend('Agg')
+        HEADLESS = True
+
+
+def subplots(key: str, *args, **kwargs):
+    '''
+    plt.subplots, but when headless the figure of the plot key is kept and
+    reused: the data are removed from its axes and their colour cycles
+    restart, so a reused figure looks like a new one. Titles, labels and
+    grids stay.
+    '''
+    if not HEADLESS:
+        return plt.subplots(*args, **kwargs)
+    if key not in FIGURES:
+        FIGURES[key] = plt.subplots(*args, **kwargs)
+    fig, axs = FIGURES[key]
+    for ax in fig.axes:
+        for artist in [*ax.lines, *ax.patches, *ax.collections]:
+            artist.remove()
+        ax.set_prop_cycle(None)
+        ax.relim()
+    return fig, axs
+
+
+def envelope(x: ndarray, y: ndarray, pixels: int) -> tuple[ndarray, ndarray]:
+    '''
+    Min/max envelope of y in pixels bins of samples, two points per bin, or
+    x, y if there are fewer than four samples per bin. Peaks survive, and NaN
+    samples (flagged channels) only blank a bin that holds nothing else.
+    '''
+    if len(y) < 4 * pixels:
+        return x, y
+    edges = np.linspace(0, len(y), pixels + 1).astype(int)[:-1]
+    x = np.repeat(x[edges], 2)
+    y = np.stack((np.fmin.reduceat(y, edges), np.fmax.reduceat(y, edges)), axis=1)
+    return x, y.ravel()
+
+
+def plot_envelope(ax, x: ndarray, y: None | ndarray = None, **kwargs):
+    '''ax.plot(x, y) or ax.plot(y), as the envelope() of the pixel columns of ax when ENVELOPE. '''
+    if y is None:
+        x, y = np.arange(len(x)), x
+    if ENVELOPE:
+        x, y = envelope(np.asarray(x), np.asarray(y), max(1, int(ax.bbox.width)))
+    return ax.plot(x, y, **kwargs)
+
+
+def render(fig, show: bool = True, fname: None | str | Path = None):
+    fig.tight_layout()
+    if fname:
+        _fname = f'{fname}.png'
+        fig.savefig(_fname)
+        LOGGER.info(f'wrote out {_fname}')
+    if show:
+        plt.show()
+    if not HEADLESS:
+        plt.close(fig)
 
 
 def plot_complex_timeseries(signal: array, reference: array, show: bool = True,
                             fname: None | str | Path = None):
     corrected = signal - reference
 
-    fig, axs = plt.subplots(2, 3, figsize=FIG_SIZE, sharex='col', sharey='row')
+    fig, axs = subplots('iq_timeseries', 2, 3, figsize=FIG_SIZE, sharex='col', sharey='row')
     fig.suptitle('Normed IQ Time-series')
     fig.supxlabel('step')
     fig.supylabel('')
@@ -31,114 +276,92 @@ def plot_complex_timeseries(signal: array, reference: array, show: bool = True,
     axs[0][0].set_ylabel('Real Part')
 
     axs[0][0].set_title('Signal')
-    axs[0][0].plot(signal.real, color='tab:blue')
-    axs[0][0].grid()
+    plot_envelope(axs[0][0], signal.real, color='tab:blue')
+    axs[0][0].grid(True)
 
     axs[0][1].set_title('Reference')
-    axs[0][1].plot(reference.real, color='tab:blue')
-    axs[0][1].grid()
+    plot_envelope(axs[0][1], reference.real, color='tab:blue')
+    axs[0][1].grid(True)
 
     axs[0][2].set_title('Corrected = Signal - Reference')
-    axs[0][2].plot(corrected.real, color='tab:blue')
-    axs[0][2].grid()
+    plot_envelope(axs[0][2], corrected.real, color='tab:blue')
+    axs[0][2].grid(True)
 
     axs[1][0].set_ylabel('Imaginary Part')
 
-    axs[1][0].plot(signal.imag, color='tab:green')
-    axs[1][0].grid()
-
-    axs[1][1].plot(reference.imag, color='tab:green')
-    axs[1][1].grid()
+    plot_envelope(axs[1][0], signal.imag, color='tab:green')
+    axs[1][0].grid(True)
 
-    axs[1][2].plot(corrected.imag, color='tab:green')
-    axs[1][2].grid()
+    plot_envelope(axs[1][1], reference.imag, color='tab:green')
+    axs[1][1].grid(True)
 
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
+    plot_envelope(axs[1][2], corrected.imag, color='tab:green')
+    axs[1][2].grid(True)
 
-    plt.close()
+    render(fig, show, fname)
 
 
 def plot_magnitude_phase_timeseries(signal: array, reference: array, show: bool = True,
                                     fname: None | str | Path = None):
     corrected = signal - reference
 
-    fig, axs = plt.subplots(2, 3, figsize=FIG_SIZE, sharex='col', sharey='row')
+    fig, axs = subplots('magnitude_phase_timeseries', 2, 3, figsize=FIG_SIZE, sharex='col', sharey='row')
     fig.suptitle('Magnitude & Phase Time-series')
     fig.supxlabel('time')
 
     axs[0][0].set_ylabel('Normed Magnitude')
 
     axs[0][0].set_title('Signal')
-    axs[0][0].plot(np.abs(signal), color='tab:orange')
-    axs[0][0].grid()
+    plot_envelope(axs[0][0], np.abs(signal), color='tab:orange')
+    axs[0][0].grid(True)
 
     axs[0][1].set_title('Reference')
-    axs[0][1].plot(np.abs(reference), color='tab:orange')
-    axs[0][1].grid()
+    plot_envelope(axs[0][1], np.abs(reference), color='tab:orange')
+    axs[0][1].grid(True)
 
     axs[0][2].set_title('Corrected = Signal - Reference')
-    axs[0][2].plot(np.abs(corrected), color='tab:orange')
-    axs[0][2].grid()
+    plot_envelope(axs[0][2], np.abs(corrected), color='tab:orange')
+    axs[0][2].grid(True)
 
     axs[1][0].set_ylabel('Angle (degree)')
 
-    axs[1][0].plot(np.angle(signal) * 180 / np.pi, color='tab:pink')
-    axs[1][0].grid()
-
-    axs[1][1].plot(np.angle(reference) * 180 / np.pi, color='tab:pink')
-    axs[1][1].grid()
+    plot_envelope(axs[1][0], np.angle(signal) * 180 / np.pi, color='tab:pink')
+    axs[1][0].grid(True)
 
-    axs[1][2].plot(np.angle(corrected) * 180 / np.pi, color='tab:pink')
-    axs[1][2].grid()
+    plot_envelope(axs[1][1], np.angle(reference) * 180 / np.pi, color='tab:pink')
+    axs[1][1].grid(True)
 
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
+    plot_envelope(axs[1][2], np.angle(corrected) * 180 / np.pi, color='tab:pink')
+    axs[1][2].grid(True)
 
-    plt.close()
+    render(fig, show, fname)
 
 
-def plot_magnitude_histogram(signal: array, reference: array, show: bool = True,
+def plot_magnitude_histogram(products: dict, show: bool = True,
                              fname: None | str | Path = None):
-    corrected = signal - reference
+    edges = products['edges']
 
-    fig, axs = plt.subplots(1, 3, figsize=FIG_SIZE, sharey=True, sharex=True)
+    fig, axs = subplots('magnitude_histogram', 1, 3, figsize=FIG_SIZE, sharey=True, sharex=True)
     # plt.figure(figsize=FIG_SIZE)
     fig.suptitle('IQ Magnitude Histogram\n(PDF Estimate)')
     fig.supxlabel('Normed Magnitude')
     fig.supylabel('Density')
 
-    axs[0].set_title('Signal')
-    axs[0].hist(np.abs(signal), bins=100, density=True, color='tab:orange')
-    axs[0].grid()
+    for ax, name, title in zip(axs, ('signal', 'reference', 'corrected'),
+                               ('Signal', 'Reference', 'Corrected = Signal - Reference')):
+        counts = products[name]
+        ax.set_title(f'{title}\nmean {products[f"{name}_mean"]:.4g}, '
+                     f'std {np.sqrt(products[f"{name}_variance"]):.4g}, '
+                     f'kurtosis {products[f"{name}_kurtosis"]:.3g}, '
+                     f'clipped {products[f"{name}_clipped"]:.3g}')
+        ax.stairs(counts / (counts.sum() * np.diff(edges)), edges, fill=True, color='tab:orange')
+        ax.grid(True)
 
-    axs[1].set_title('Reference')
-    axs[1].hist(np.abs(reference), bins=100, density=True, color='tab:orange')
-    axs[1].grid()
-
-    axs[2].set_title('Corrected = Signal - Reference')
-    axs[2].hist(np.abs(corrected), bins=100, density=True, color='tab:orange')
-    axs[2].grid()
-
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
+    # the fixed edges span full scale, show the populated bins
+    populated = np.flatnonzero(products['signal'] + products['reference'] + products['corrected'])
+    axs[0].set_xlim(edges[populated[0]], edges[populated[-1] + 1])
 
-    plt.close()
+    render(fig, show, fname)
 
 
 # def plot_spectrogram(n, N):
@@ -194,204 +417,656 @@ def plot_spectrum(series: array, attrs: dict, nbins: int = 8192, N_SEG_LIM=2048,
     plt.close()
 
 
+class MeanWaveform:
+    '''Mean over rows of the signal and reference waveforms. '''
+
+    def __init__(self, meta: dict):
+        self.meta = meta
+        self.sums = None
+        self.rows = 0
+
+    def update(self, chunk: Chunk):
+        if self.sums is None:
+            self.sums = np.zeros((2, chunk.signal.shape[1]), dtype=np.complex128)
+        self.sums[0] += chunk.signal.sum(axis=0, dtype=np.complex128)
+        self.sums[1] += chunk.reference.sum(axis=0, dtype=np.complex128)
+        self.rows += len(chunk)
+
+    def finish(self) -> dict:
+        return {'signal': self.sums[0] / self.rows,
+                'reference': self.sums[1] / self.rows}
+
+
+def clipped(iq: ndarray) -> ndarray:
+    '''Samples of iq with I or Q at the ADC limits. '''
+    return (np.abs(iq.real) >= CLIP_LEVEL) | (np.abs(iq.imag) >= CLIP_LEVEL)
+
+
+class HistogramAccumulator:
+    '''
+    Histogram of the magnitude of every sample of the signal, reference and
+    corrected rows on fixed bin edges (the last bin takes magnitudes beyond
+    max_magnitude), with the mean, variance and kurtosis of the magnitude
+    and the fraction of samples clipped at the ADC limits. A corrected
+    sample is clipped if either of its samples is.
+    '''
+
+    def __init__(self, meta: dict, bins: int = HIST_BINS, max_magnitude: float = HIST_MAX):
+        self.meta = meta
+        self.bins = bins
+        self.edges = np.linspace(0, max_magnitude, bins + 1)
+        self.counts = np.zeros((3, bins), dtype=np.int64)
+        self.moments = [dsp.Moments() for _ in range(3)]
+        self.clipped = np.zeros(3, dtype=np.int64)
+        self.samples = 0
+
+    def update(self, chunk: Chunk):
+        clip = clipped(chunk.signal), clipped(chunk.reference)
+        clip += (clip[0] | clip[1],)
+        for i, channel in enumerate(('signal', 'reference', 'corrected')):
+            magnitude = chunk.magnitude(channel)
+            # magnitudes on an edge (a whole number of ADC codes in the corrected
+            # rows) go to the upper bin whatever the rounding of either precision
+            index = np.minimum(magnitude * (self.bins / self.edges[-1]) + HIST_TIE, self.bins - 1)
+            self.counts[i] += np.bincount(index.astype(np.intp).ravel(), minlength=self.bins)
+            self.moments[i].update(magnitude)
+            self.clipped[i] += clip[i].sum()
+        self.samples += chunk.signal.size
+
+    def finish(self) -> dict:
+        products = {'edges': self.edges}
+        for name, counts, moments, clipped in zip(('signal', 'reference', 'corrected'),
+                                                  self.counts, self.moments, self.clipped):
+            products[name] = counts
+            products[f'{name}_mean'] = moments.mean
+            products[f'{name}_variance'] = moments.variance
+            products[f'{name}_kurtosis'] = moments.kurtosis
+            products[f'{name}_clipped'] = clipped / self.samples
+        return products
+
+
+def magnitude_histogram(signal: ndarray, reference: ndarray, meta: dict, show: bool = True,
+                        fname: None | Path | str = None):
+    histogram = HistogramAccumulator(meta)
+    histogram.update(Chunk(signal, reference))
+    plot_magnitude_histogram(histogram.finish(), show, fname)
+
+
+def spectrum_products(P_total: ndarray, rows: int, meta: dict, nbins: int,
+                      nperseg: int, window: str) -> tuple[ndarray, ndarray]:
+    '''
+    Calibrate a dsp.psd_sum over rows rows.
+
+    Returns the frequency (MHz) and the mean PSD (dB/Hz), ascending frequency.
+    '''
+    P_avg = P_total / rows
+    return calibrated_spectrum(dsp.density(P_avg, meta['sample_rate'], nperseg, window), meta)
+
+
+def calibrated_spectrum(P_hz: ndarray, meta: dict) -> tuple[ndarray, ndarray]:
+    '''Frequency (MHz) and dB/Hz of a PSD in FFT order, ascending frequency. '''
+    freqs = np.fft.fftshift(dsp.frequencies(len(P_hz), meta['sample_rate']))
+    P_db_hz = 10. * np.log10(np.fft.fftshift(P_hz))
+    # Shift frequency spectra back to the intended range
+    freqs = (freqs + meta['frequency']) / 1e6
+    return freqs, P_db_hz
+
+
+class SpectrumAccumulator:
+    '''Mean PSD of the signal, reference and corrected rows (DC removed). '''
+
+    def __init__(self, meta: dict, nbins: int = dsp.NBINS,
+                 N_SEG_LIM: int = dsp.N_SEG_LIM, window: str = dsp.WINDOW):
+        self.meta = meta
+        self.nbins = nbins
+        self.nperseg = dsp.nperseg(nbins, N_SEG_LIM)
+        self.window = window
+        self.P_total = np.zeros((3, nbins))
+        self.rows = 0
+
+    def update(self, chunk: Chunk):
+        for P, channel in zip(self.P_total, ('signal', 'reference', 'corrected')):
+            P += chunk.psd_sum(channel, self.nperseg, self.nbins, self.window)
+        self.rows += len(chunk)
+
+    def finish(self) -> dict:
+        products = dict()
+        for name, P in zip(('signal', 'reference', 'corrected'), self.P_total):
+            products['frequency'], products[name] = spectrum_products(
+                    P, self.rows, self.meta, self.nbins, self.nperseg, self.window)
+        return products
+
+
+class PFBAccumulator:
+    '''
+    Mean polyphase filterbank PSD of the signal, reference and corrected
+    rows (DC removed), nchan channels of taps taps, calibrated and on the
+    frequency axis of SpectrumAccumulator with nbins = nchan. Groups with
+    rows shorter than the filter (taps * nchan) give no products.
+    '''
+
+    def __init__(self, meta: dict, nchan: int = dsp.NBINS, taps: int = dsp.PFB_TAPS,
+                 window: str = dsp.WINDOW):
+        self.meta = meta
+        self.nchan = nchan
+        self.taps = taps
+        self.window = window
+        self.P_total = np.zeros((3, nchan))
+        self.rows = 0
+        self.short = False
+
+    def update(self, chunk: Chunk):
+        if chunk.signal.shape[1] < self.taps * self.nchan:
+            if not self.short:
+                LOGGER.warning(f'rows of {chunk.signal.shape[1]} samples are shorter than the '
+                               f'{self.taps} x {self.nchan} filterbank, skipping')
+            self.short = True
+            return
+        for P, channel in zip(self.P_total, ('signal', 'reference', 'corrected')):
+            P += chunk.pfb_sum(channel, self.nchan, self.taps, self.window)
+        self.rows += len(chunk)
+
+    def finish(self) -> None | dict:
+        if self.rows == 0:
+            return None
+        products = dict()
+        for name, P in zip(('signal', 'reference', 'corrected'), self.P_total):
+            P_hz = dsp.pfb_density(P / self.rows, self.meta['sample_rate'],
+                                   self.nchan, self.taps, self.window)
+            products['frequency'], products[name] = calibrated_spectrum(P_hz, self.meta)
+        return products
+
+
+class RFIAccumulator:
+    '''
+    Mean PSD of the signal, reference and corrected rows (DC removed) as
+    SpectrumAccumulator, without the channels of each row flagged as RFI
+    (dsp.rfi_flags: spectral kurtosis and MAD outliers of the row). Also
+    the fraction of rows flagged per channel ({name}_occupancy) and the
+    flags, rows x channels packed 8 to a byte ({name}_mask, numpy.packbits),
+    both in ascending frequency.
+    '''
+
+    def __init__(self, meta: dict, nbins: int = dsp.NBINS, N_SEG_LIM: int = dsp.N_SEG_LIM,
+                 window: str = dsp.WINDOW, sk_sigma: float = dsp.SK_SIGMA,
+                 mad_sigma: float = dsp.MAD_SIGMA):
+        self.meta = meta
+        self.nbins = nbins
+        self.nperseg = dsp.nperseg(nbins, N_SEG_LIM)
+        self.window = window
+        self.sk_sigma = sk_sigma
+        self.mad_sigma = mad_sigma
+        self.window_sum = dsp.window_sums(window, self.nperseg)[0]
+        self.P_total = np.zeros((3, nbins))
+        self.counts = np.zeros((3, nbins))
+        self.masks = ([], [], [])
+        self.rows = 0
+
+    def update(self, chunk: Chunk):
+        for P, counts, masks, channel in zip(self.P_total, self.counts, self.masks,
+                                             ('signal', 'reference', 'corrected')):
+            S1, S2, M = chunk.sk_sums(channel, self.nperseg, self.nbins, self.window)
+            flags = dsp.rfi_flags(S1, S2, M, self.sk_sigma, self.mad_sigma)
+            # S1 / M is the psd() scaled by window_sums()[0]**2
+            P += np.where(flags, 0, S1).sum(axis=0) / (M * self.window_sum**2)
+            counts += len(flags) - flags.sum(axis=0)
+            masks.append(np.packbits(np.fft.fftshift(flags, axes=-1), axis=-1))
+        self.rows += len(chunk)
+
+    def finish(self) -> dict:
+        products = dict()
+        for name, P, counts, masks in zip(('signal', 'reference', 'corrected'),
+                                          self.P_total, self.counts, self.masks):
+            P_avg = dsp.masked_mean(P, counts, self.rows)
+            products['frequency'], products[name] = calibrated_spectrum(
+                    dsp.density(P_avg, self.meta['sample_rate'], self.nperseg, self.window), self.meta)
+            products[f'{name}_occupancy'] = np.fft.fftshift(1 - counts / max(self.rows, 1))
+            products[f'{name}_mask'] = np.concatenate(masks) if masks else np.zeros(
+                    (0, -(-self.nbins // 8)), dtype=np.uint8)
+        return products
+
+
+def stored_rfi(group) -> dict:
+    '''
+    RFIAccumulator products of a group written in spectrometer mode with
+    online flagging (collect.py --spectrometer --rfi).
+    '''
+    products = dict(zip(('frequency', 'signal', 'reference', 'corrected'), stored_spectra(group)))
+    for name in ('signal', 'reference', 'corrected'):
+        products[f'{name}_occupancy'] = group[f'{name}_rfi_occupancy'][:]
+        products[f'{name}_mask'] = group[f'{name}_rfi_mask'][:]
+    return products
+
+
+def plot_rfi(products: dict, show: bool = True, fname: None | Path | str = None):
+    freqs = products['frequency']
+
+    fig, axs = subplots('rfi', 2, 3, figsize=FIG_SIZE, sharey='row', sharex=True)
+    fig.suptitle('RFI Flagged Power Spectral Density Estimate')
+    fig.supxlabel('Frequency (MHz)')
+
+    for i, (name, title) in enumerate((('signal', 'Signal'), ('reference', 'Reference'),
+                                       ('corrected', 'Corrected = Signal - Reference'))):
+        axs[0][i].set_title(title)
+        plot_envelope(axs[0][i], freqs, products[name])
+        axs[0][i].grid(True)
+
+        plot_envelope(axs[1][i], freqs, products[f'{name}_occupancy'])
+        axs[1][i].grid(True)
+
+    axs[0][0].set_ylabel('Power Spectral Density (dB/Hz)')
+    axs[1][0].set_ylabel('Rows Flagged (fraction)')
+
+    render(fig, show, fname)
+
+
 def spectrum_integration(signal: ndarray, reference:ndarray, meta: dict, nbins: int = 8192,
                          N_SEG_LIM=2048, show: bool = True,
                          fname: None | Path | str = None):
-    window = 'hann'
-    if nbins < N_SEG_LIM:
-        nperseg = nbins
-    else:
-        nperseg = N_SEG_LIM
+    spectrum = SpectrumAccumulator(meta, nbins, N_SEG_LIM)
+    spectrum.update(Chunk(signal, reference))
+    plot_spectrum_products(spectrum.finish(), show, fname)
+
 
+def stored_spectra(group) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+    '''
+    Frequency (MHz) and signal, reference, corrected PSD (dB/Hz) of a group
+    written in spectrometer mode (collect.py --spectrometer).
+    '''
+    freqs = group['psd_frequency'][:] / 1e6
+    return (freqs, *(10. * np.log10(group[f'{name}_psd'][:])
+                     for name in ('signal', 'reference', 'corrected')))
 
-    def process(data):
-        freqs = np.zeros(nbins)
-        Pxx_total = np.zeros(nbins)
-        for iq in data:
-            # compensate for DC spike
-            iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-            freqs, p_xx = welch(iq, fs=meta['sample_rate'], nperseg=nperseg,
-                                nfft=nbins, noverlap=0, scaling='spectrum',
-                                window=window, detrend=False, return_onesided=False)
-            Pxx_total += p_xx
-
-        freqs = np.fft.fftshift(freqs)
-        Pxx_total = np.fft.fftshift(Pxx_total)
-
-        P_avg = Pxx_total / len(data)
-        win = get_window(window, nperseg)
-        P_avg_hz = P_avg * ((win.sum()**2) / (win*win).sum()) / meta['sample_rate']
-        P_avg_db_hz = 10. * np.log10(P_avg_hz)
-        # Shift frequency spectra back to the intended range
-        freqs = (freqs + meta['frequency']) / 1e6
-        return freqs, P_avg_db_hz
-    
-    freqs_sig, P_sig = process(signal)
-    freqs_ref, P_ref = process(reference)
-    freqs_cor, P_cor = process(signal - reference)
-
-    fig, axs = plt.subplots(3, figsize=FIG_SIZE, sharey=True, sharex=True)
-    fig.suptitle('Power Spectral Density Estimate')
+
+def plot_spectrum_products(products: dict, show: bool = True,
+                           fname: None | Path | str = None,
+                           title: str = 'Power Spectral Density Estimate'):
+    plot_spectra(products['frequency'], products['signal'], products['reference'],
+                 products['corrected'], show, fname, title)
+
+
+def plot_spectra(freqs: ndarray, P_sig: ndarray, P_ref: ndarray, P_cor: ndarray,
+                 show: bool = True, fname: None | Path | str = None,
+                 title: str = 'Power Spectral Density Estimate'):
+    fig, axs = subplots('spectrum', 3, figsize=FIG_SIZE, sharey=True, sharex=True)
+    fig.suptitle(title)
     fig.supxlabel('Frequency (MHz)')
     fig.supylabel('Power Spectral Density (dB/Hz)')
 
     axs[0].set_title('Signal')
-    axs[0].plot(freqs_sig, P_sig)
-    axs[0].grid()
+    plot_envelope(axs[0], freqs, P_sig)
+    axs[0].grid(True)
 
     axs[1].set_title('Reference')
-    axs[1].plot(freqs_ref, P_ref)
-    axs[1].grid()
+    plot_envelope(axs[1], freqs, P_ref)
+    axs[1].grid(True)
 
     axs[2].set_title('Corrected = Signal - Reference')
-    axs[2].plot(freqs_cor, P_cor)
-    axs[2].grid()
+    plot_envelope(axs[2], freqs, P_cor)
+    axs[2].grid(True)
 
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
-    plt.close()
+    render(fig, show, fname)
+
+
+class ACFAccumulator:
+    '''
+    Mean of the normalized autocorrelation function of each row, lags 0 to
+    max_lag (default all), by one inverse FFT of the mean normalized power
+    spectrum (Wiener-Khinchin) rather than a correlation per row.
+    '''
+
+    def __init__(self, meta: dict, max_lag: None | int = None):
+        self.meta = meta
+        self.max_lag = max_lag
+        self.nfft = None
+        self.P_total = None
+        self.rows = 0
+
+    def update(self, chunk: Chunk):
+        if self.P_total is None:
+            width = chunk.signal.shape[1]
+            if self.max_lag is None or self.max_lag >= width:
+                self.max_lag = width - 1
+            self.nfft = dsp.acf_nfft(width, self.max_lag)
+            self.P_total = np.zeros((3, self.nfft))
+        for P, channel in zip(self.P_total, ('signal', 'reference', 'corrected')):
+            P += chunk.acf_power_sum(channel, self.nfft)
+        self.rows += len(chunk)
+
+    def finish(self) -> dict:
+        # Create a time lag vector for plotting
+        products = {'lags': np.arange(0, self.max_lag + 1) / self.meta['sample_rate']}
+        for name, P in zip(('signal', 'reference', 'corrected'), self.P_total):
+            # average the autocorrelation functions
+            products[name] = dsp.acf(P / self.rows, self.max_lag)
+        return products
 
 
 def autocorrelate(signal: ndarray, reference: ndarray, meta: dict, show: bool = True,
                   fname: None | Path | str = None):
-    def compute(data):
-        ACF = list()
-        for sample in data:
-            acf = correlate(sample, sample, mode='full', method='fft')
-            # Normalize the autocorrelation function
-            acf /= np.max(acf)
-            ACF.append(acf)
+    acf = ACFAccumulator(meta)
+    acf.update(Chunk(signal, reference))
+    plot_autocorrelation(acf.finish(), show, fname)
 
-        # Create a time lag vector for plotting
-        lags = np.arange(0, len(data[0])) / meta['sample_rate']
-
-        ACF = np.vstack(ACF)
-        # average the autocorrelation functions
-        return lags, np.sum(ACF, axis=0) / len(ACF)
 
-    lags_sig, acf_sig = compute(signal)
-    lags_ref, acf_ref = compute(reference)
-    lags_cor, acf_cor = compute(signal - reference)
+def plot_autocorrelation(products: dict, show: bool = True,
+                         fname: None | Path | str = None):
+    lags = products['lags']
 
-    fig, axs = plt.subplots(3, figsize=FIG_SIZE, sharey=True, sharex=True)
+    fig, axs = subplots('autocorrelate', 3, figsize=FIG_SIZE, sharey=True, sharex=True)
     # plt.figure(figsize=FIG_SIZE)
     fig.suptitle('Mean Autocorrelation Function')
     fig.supxlabel('Lag (second)')
-    plt.ylim(-0.5, 0.5)
+    axs[2].set_ylim(-0.5, 0.5)
 
     axs[0].set_title('Signal')
-    axs[0].plot(lags_sig, acf_sig[len(lags_sig) - 1:])
+    plot_envelope(axs[0], lags, products['signal'].real)
     axs[0].grid(True)
 
     axs[1].set_title('Reference')
-    axs[1].plot(lags_ref, acf_ref[len(lags_ref) - 1:])
+    plot_envelope(axs[1], lags, products['reference'].real)
     axs[1].grid(True)
 
     axs[2].set_title('Corrected = Signal - Reference')
-    axs[2].plot(lags_cor, acf_cor[len(lags_cor) - 1:])
+    plot_envelope(axs[2], lags, products['corrected'].real)
     axs[2].grid(True)
 
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
-
-    plt.close()
+    render(fig, show, fname)
+
+
+class RadiometerAccumulator:
+    '''
+    Differential radiometer: the detected power of the signal, the reference
+    and their difference (through a one pole integrator, alpha) as continuous
+    time series over all the rows, decimated with anti-aliasing, and their
+    power spectral density.
+
+    The integrator and decimation filter states carry from row to row and
+    chunk to chunk, so only the decimated series are held.
+    '''
+
+    def __init__(self, meta: dict, alpha: float = 0.9, decimation: int = DECIMATION,
+                 N_SEG_LIM: int = dsp.N_SEG_LIM, window: str = dsp.WINDOW):
+        self.meta = meta
+        self.b = [1 - alpha]
+        self.a = [1, -alpha]
+        self.zi = None
+        self.decimation = decimation
+        self.decimator = dsp.Decimator(decimation)
+        self.N_SEG_LIM = N_SEG_LIM
+        self.window = window
+        self.series = []
+
+    def update(self, chunk: Chunk):
+        # rows in time order, one series, filtered in float64 at either
+        # precision as the filter states integrate the whole observation
+        sig = chunk.power('signal').astype(np.float64).ravel()
+        ref = chunk.power('reference').astype(np.float64).ravel()
+        if self.zi is None:
+            self.zi = lfilter_zi(self.b, self.a) * (sig - ref)[:dsp.WARMUP].mean()
+        cor, self.zi = lfilter(self.b, self.a, sig - ref, zi=self.zi)
+        self.series.append(self.decimator(np.stack((sig, ref, cor))))
+
+    def finish(self) -> dict:
+        series = np.concatenate(self.series, axis=1)
+        rate = self.meta['sample_rate'] / self.decimation
+        products = {'time': np.arange(series.shape[1]) / rate}
+        for name, data in zip(('signal', 'reference', 'corrected'), series):
+            products[name] = data
+            with dsp.fft_workers():
+                products['frequency'], P = welch(data, rate, window=self.window,
+                                                 nperseg=min(len(data), self.N_SEG_LIM))
+            products[f'{name}_spectrum'] = 10. * np.log10(P)
+        return products
 
 
 def differential_radiometer(signal: ndarray, reference:ndarray, meta: dict, show: bool = True,fname: None | Path | str = None):
-    nbins: int = 8192
-    N_SEG_LIM = 2048
-
-    window = 'hann'
-    if nbins < N_SEG_LIM:
-        nperseg = nbins
-    else:
-        nperseg = N_SEG_LIM
-
+    radiometer = RadiometerAccumulator(meta)
+    radiometer.update(Chunk(signal, reference))
+    plot_radiometer(radiometer.finish(), show, fname)
 
-    def process(data):
-        freqs = np.zeros(nbins)
-        Pxx_total = np.zeros(nbins)
-        for iq in data:
-            # compensate for DC spike
-            iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-            freqs, p_xx = welch(iq, fs=meta['sample_rate'], nperseg=nperseg,
-                                nfft=nbins, noverlap=0, scaling='spectrum',
-                                window=window, detrend=False, return_onesided=False)
-            Pxx_total += p_xx
 
-        freqs = np.fft.fftshift(freqs)
-        Pxx_total = np.fft.fftshift(Pxx_total)
+def plot_radiometer(products: dict, show: bool = True, fname: None | Path | str = None):
+    time = products['time']
+    freqs = products['frequency']
 
-        P_avg = Pxx_total / len(data)
-        win = get_window(window, nperseg)
-        P_avg_hz = P_avg * ((win.sum()**2) / (win*win).sum()) / meta['sample_rate']
-        P_avg_db_hz = 10. * np.log10(P_avg_hz)
-        # Shift frequency spectra back to the intended range
-        freqs = (freqs + meta['frequency']) / 1e6
-        return freqs, P_avg_db_hz
-
-    alpha = 0.9
-    a = [1 - alpha]
-    b = [1, -alpha]
-    N = 10  # decimation, 1 in N
-
-    sig = np.abs(signal) ** 2
-    ref = np.abs(reference) ** 2
-    cor = lfilter(a, b, sig - ref)
-
-    f_sig, P_sig = process(sig[::N])
-    f_ref, P_ref = process(ref[::N])
-    f_cor, P_cor = process(cor[::N])
-
-    sig = sig.mean(axis=1)
-    ref = ref.mean(axis=1)
-    cor = cor.mean(axis=1)  # todo single pole IIR filter
-
-
-    fig, axs = plt.subplots(2, 3, figsize=FIG_SIZE, sharey='row', sharex='row')
+    fig, axs = subplots('differential', 2, 3, figsize=FIG_SIZE, sharey='row', sharex='row')
     fig.suptitle('Differential Radiometer')
     # fig.supylabel('Power?')
 
     axs[0][0].set_title('Signal')
-    axs[0][0].plot(sig)
+    plot_envelope(axs[0][0], time, products['signal'])
     axs[0][0].grid(True)
 
-    axs[1][0].plot(f_sig, P_sig)
+    plot_envelope(axs[1][0], freqs, products['signal_spectrum'])
     axs[1][0].grid(True)
 
     axs[0][1].set_title('Reference')
-    axs[0][1].plot(ref)
+    plot_envelope(axs[0][1], time, products['reference'])
     axs[0][1].grid(True)
 
-    axs[1][1].plot(f_ref, P_ref)
+    plot_envelope(axs[1][1], freqs, products['reference_spectrum'])
     axs[1][1].grid(True)
 
     axs[0][2].set_title('Signal - Reference')
-    axs[0][2].plot(cor)
+    plot_envelope(axs[0][2], time, products['corrected'])
     axs[0][2].grid(True)
 
-    axs[1][2].plot(f_cor, P_cor)
+    plot_envelope(axs[1][2], freqs, products['corrected_spectrum'])
     axs[1][2].grid(True)
 
-    plt.tight_layout()
-    if fname:
-        _fname = f'{fname}.png'
-        plt.savefig(_fname)
-        LOGGER.info(f'wrote out {_fname}')
-    if show:
-        plt.show()
-
-    plt.close()
+    axs[0][1].set_xlabel('Time (second)')
+    axs[1][1].set_xlabel('Frequency (Hz)')
+    axs[1][0].set_ylabel('Power Spectral Density (dB/Hz)')
+
+    render(fig, show, fname)
+
+
+@dataclass
+class Reducer:
+    title: str
+    accumulator: type      # update(chunk) per Chunk, finish() -> products
+    plot: Callable         # plot(products, show, fname)
+    suffix: str            # reduction product file name, {group}-{suffix}.png
+    params: dict = field(default_factory=dict)  # accumulator keyword arguments
+    products: tuple = ()     # shared Chunk products held, see PRODUCT_COPIES
+    temporaries: float = 0.  # bytes per sample allocated by update() outside the dsp batches
+    cost: float = 0.1        # time per sample relative to the spectrum, see split_reducers
+
+
+REDUCERS = {
+        'iq_timeseries': Reducer(
+            'IQ Timeseries', MeanWaveform,
+            lambda p, show, fname: plot_complex_timeseries(p['signal'], p['reference'], show, fname),
+            'iq_timeseries'),
+        'magnitude_phase_timeseries': Reducer(
+            'Magnitude Phase Timeseries', MeanWaveform,
+            lambda p, show, fname: plot_magnitude_phase_timeseries(p['signal'], p['reference'], show, fname),
+            'magnitude_phase_timeseries'),
+        'magnitude_histogram': Reducer('Magnitude Histogram', HistogramAccumulator,
+                                       plot_magnitude_histogram, 'magnitude_histogram',
+                                       {'bins': HIST_BINS, 'max_magnitude': HIST_MAX},
+                                       ('corrected', 'power', 'magnitude'), 48., 0.4),
+        'spectrum': Reducer('Spectrum', SpectrumAccumulator, plot_spectrum_products, 'spectral',
+                            {'nbins': dsp.NBINS, 'N_SEG_LIM': dsp.N_SEG_LIM, 'window': dsp.WINDOW},
+                            ('corrected',), cost=1.),
+        'pfb': Reducer('Polyphase Filterbank Spectrum', PFBAccumulator,
+                       lambda p, show, fname: plot_spectrum_products(
+                           p, show, fname, 'Polyphase Filterbank Power Spectral Density'),
+                       'pfb', {'nchan': dsp.NBINS, 'taps': dsp.PFB_TAPS, 'window': dsp.WINDOW},
+                       ('corrected',), cost=0.5),
+        'rfi': Reducer('RFI Flagged Spectrum', RFIAccumulator, plot_rfi, 'rfi',
+                       {'nbins': dsp.NBINS, 'N_SEG_LIM': dsp.N_SEG_LIM, 'window': dsp.WINDOW,
+                        'sk_sigma': dsp.SK_SIGMA, 'mad_sigma': dsp.MAD_SIGMA},
+                       ('corrected', 'sk_sums'), cost=0.95),
+        'autocorrelate': Reducer('Autocorrelation Function', ACFAccumulator,
+                                 plot_autocorrelation, 'ACF', {'max_lag': None}, ('corrected',),
+                                 cost=0.8),
+        'differential': Reducer('Differential Radiometer', RadiometerAccumulator,
+                                plot_radiometer, 'differential',
+                                {'alpha': 0.9, 'decimation': DECIMATION,
+                                 'N_SEG_LIM': dsp.N_SEG_LIM, 'window': dsp.WINDOW},
+                                ('power',), 80., 0.3),
+        }
+# reducers sharing the work of a pass (an accumulator, the spectral kurtosis
+# sums) which split_reducers keeps in one unit
+BUNDLES = (('iq_timeseries', 'magnitude_phase_timeseries'), ('spectrum', 'rfi'))
+ALIASES = {'spectral': 'spectrum', 'filterbank': 'pfb', 'acf': 'autocorrelate', 'ACF': 'autocorrelate',
+           'auto': 'autocorrelate', 'diff': 'differential'}
+
+
+def write_metadata(attrs, fname: Path):
+    with open(fname, 'w') as metadata:
+        for i, (key, val) in enumerate(attrs.items()):
+            if i > 0:
+                metadata.write('\n')
+            metadata.write(f'{key}: {val}')
+
+
+def split_reducers(names: list[str], parts: int) -> list[list[str]]:
+    '''
+    The reducers names split into at most parts units of similar cost
+    (Reducer.cost, a BUNDLES bundle costs its dearest member), heaviest
+    first onto the lightest unit. Each unit reads the group again, so
+    reducers only split to put more --jobs than groups to work.
+    '''
+    bundles = dict()
+    for name in names:
+        key = next((bundle for bundle in BUNDLES if name in bundle), name)
+        bundles.setdefault(key, []).append(name)
+    bundles = list(bundles.values())
+    units = [[] for _ in range(min(parts, len(bundles)))]
+    costs = [0.] * len(units)
+    for bundle in sorted(bundles, key=lambda bundle: -max(REDUCERS[name].cost for name in bundle)):
+        lightest = costs.index(min(costs))
+        units[lightest] += bundle
+        costs[lightest] += max(REDUCERS[name].cost for name in bundle)
+    return [[name for name in names if name in unit] for unit in units]
+
+
+def reducer_params(name: str, params: None | dict = None) -> dict:
+    '''Accumulator keyword arguments of reducer name, REDUCERS defaults updated by params[name]. '''
+    return {**REDUCERS[name].params, **(params or dict()).get(name, dict())}
+
+
+def reduce_group(group, names: list[str], rows: None | ndarray = None,
+                 max_memory: float = MAX_MEMORY, params: None | dict = None,
+                 precision: str = 'double') -> dict:
+    '''
+    Products of each reducer of names over the rows (indices, default the
+    valid rows) of group, in a single pass of chunks of at most max_memory MB.
+    The samples and their FFTs are complex64 or complex128 by precision (see
+    PRECISIONS), sums over rows are float64 either way.
+
+    Every chunk is read once and fed to each accumulator, reducers with the
+    same accumulator and parameters share one. params overrides reducer
+    parameters, see reducer_params. Reducers which do not apply
+    (spectrometer mode groups hold no IQ, accumulators finishing with None)
+    are left out, a group without valid rows (a dongle lost every row)
+    gives no products. Spectrometer mode groups give their stored spectrum, and
+    their online RFI flags as rfi.
+    '''
+    if 'IQ' not in group:
+        products = dict()
+        if 'spectrum' in names:
+            products['spectrum'] = dict(zip(('frequency', 'signal', 'reference', 'corrected'),
+                                            stored_spectra(group)))
+        if 'rfi' in names and 'signal_rfi_mask' in group:
+            products['rfi'] = stored_rfi(group)
+        if set(names) - set(products):
+            LOGGER.warning(f'{group.name} holds spectra only, skipping')
+        return products
+    if rows is None:
+        rows = valid_rows(group)
+    if len(rows) == 0:
+        LOGGER.warning(f'{group.name} has no valid rows, skipping')
+        return dict()
+
+    def shared(name):
+        return REDUCERS[name].accumulator, tuple(sorted(reducer_params(name, params).items()))
+
+    accumulators = dict()
+    for name in names:
+        if shared(name) not in accumulators:
+            accumulators[shared(name)] = REDUCERS[name].accumulator(
+                    group.attrs, **reducer_params(name, params))
+    for chunk in iter_chunks(group, rows, max_memory, PRECISIONS[precision], names):
+        for accumulator in accumulators.values():
+            accumulator.update(chunk)
+        # free the chunk and its products before the next one is read
+        del chunk
+    finished = {key: accumulator.finish() for key, accumulator in accumulators.items()}
+    return {name: finished[shared(name)] for name in names
+            if finished[shared(name)] is not None}
+
+
+def reduce_unit(data: Path, i: int, names: list[str], show: bool, products_dir: Path,
+                rows: None | ndarray = None, max_memory: float = MAX_MEMORY,
+                params: None | dict = None, precision: str = 'double',
+                fft_workers: int = dsp.FFT_WORKERS, cached: None | dict = None) -> dict:
+    '''
+    Work unit of reduce_units: reduce_group of data/i with the reducers names,
+    opening data read-only, with FFTs on fft_workers threads, and plot the
+    products into products_dir.
+
+    Reducers with cached products are only plotted. Returns the products
+    which were computed.
+    '''
+    if not show:
+        headless()
+    # set per unit, --jobs processes start with the defaults
+    dsp.fft_backend(workers=fft_workers)
+    cached = cached or dict()
+    missing = [name for name in names if name not in cached]
+    products = dict()
+    if missing:
+        LOGGER.info(f'{", ".join(REDUCERS[name].title for name in missing)} Reduction of data/{i}')
+        with rawcapture.open_capture(data) as file:
+            products = reduce_group(file[f'data/{i}'], missing, rows, max_memory, params,
+                                    precision)
+    for name in names:
+        if name in cached or name in products:
+            reducer = REDUCERS[name]
+            reducer.plot(cached.get(name) or products[name], show,
+                         products_dir / f'{i}-{reducer.suffix}')
+    return products
+
+
+def _reduce_unit(unit: tuple) -> dict:
+    return reduce_unit(*unit)
+
+
+def reduce_units(units: list[tuple], jobs: int = 1,
+                 products_cache: None | cache.ReductionCache = None):
+    '''
+    Run the reduce_unit argument tuples units, serially or on a pool of jobs
+    processes. Units are independent, each writes its own products.
+
+    With a products_cache, cached products are only plotted and the others
+    are stored, by this process.
+    '''
+    keys = [dict() for _ in units]
+    if products_cache is not None:
+        keys = [{name: cache.key(cache.identity(data), f'data/{i}', name,
+                                 reducer_params(name, params), rows, precision)
+                 for name in names}
+                for data, i, names, _, _, rows, _, params, precision, _ in units]
+        cached = [{name: products for name, key in unit_keys.items()
+                   if (products := products_cache.get(key)) is not None}
+                  for unit_keys in keys]
+        units = [(*unit, unit_cached) for unit, unit_cached in zip(units, cached)]
+
+    def store(results):
+        for unit, unit_keys, products in zip(units, keys, results):
+            for name, unit_products in products.items():
+                if products_cache is not None:
+                    products_cache.put(unit_keys[name], unit_products, cache.identity(unit[0]))
+
+    if jobs <= 1:
+        store(map(_reduce_unit, units))
+        return
+    with get_context('spawn').Pool(jobs) as pool:
+        store(pool.imap(_reduce_unit, units))
 
 
 if __name__ == '__main__':
@@ -399,16 +1074,14 @@ if __name__ == '__main__':
 
     PRODUCTS_DIR = Path('reduction-products')
     # all
-    reducers = ['iq_timeseries', 'magnitude_phase_timeseries',
-                'magnitude_histogram', 'spectrum', 'autocorrelate',
-                'differential']
+    reducers = list(REDUCERS)
     # spectral
     # reducers = ['spectrum', 'autocorrelate']
 
     parser = ArgumentParser()
     parser.add_argument('--reducer', '-r', type=str, nargs='+',
                         help='In which way would you like to reduce the data?')
-    parser.add_argument('--data', '-d', type=Path, help='path to h5py data file')
+    parser.add_argument('--data', '-d', type=Path, help='path to h5py data file or rawcapture directory')
     parser.add_argument('--show', action='store_true', default=False,
                         help='pass to open plot interactively')
     parser.add_argument('--save', default=False, action='store_true',
@@ -417,10 +1090,52 @@ if __name__ == '__main__':
                         help='select a row in a dataset, otherwise mean of dataset')
     parser.add_argument('--products', default=PRODUCTS_DIR, type=Path, 
                         help=f'define the directory to store reduction prodcuts in, default {PRODUCTS_DIR}')
+    parser.add_argument('--max-memory', default=MAX_MEMORY, type=float,
+                        help=f'memory ceiling of the streamed chunks in MB, shared by the jobs, default {MAX_MEMORY}')
+    parser.add_argument('--max-lag', default=None, type=int,
+                        help='longest lag of the autocorrelation function in samples, default the row width')
+    parser.add_argument('--decimation', default=DECIMATION, type=int,
+                        help=f'decimation of the radiometer time series, stages of at most {dsp.MAX_STAGE}, default {DECIMATION}')
+    parser.add_argument('--pfb-channels', default=dsp.NBINS, type=int,
+                        help=f'channels of the polyphase filterbank spectrum, default {dsp.NBINS}')
+    parser.add_argument('--pfb-taps', default=dsp.PFB_TAPS, type=int,
+                        help=f'taps per channel of the polyphase filterbank, default {dsp.PFB_TAPS}')
+    parser.add_argument('--sk-sigma', default=dsp.SK_SIGMA, type=float,
+                        help=f'RFI threshold of the spectral kurtosis in standard deviations, default {dsp.SK_SIGMA}')
+    parser.add_argument('--mad-sigma', default=dsp.MAD_SIGMA, type=float,
+                        help=f'RFI threshold of the power above the bandpass in robust standard deviations, default {dsp.MAD_SIGMA}')
+    parser.add_argument('--cache', default=None, type=Path,
+                        help='sidecar HDF5 cache of reduction products, default {products}/{data stem}/cache.h5')
+    parser.add_argument('--cache-size', default=cache.MAX_SIZE, type=float,
+                        help=f'size limit of the cache in MB, default {cache.MAX_SIZE}')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='pass to reduce everything from the IQ, without reading or writing the cache')
+    parser.add_argument('--jobs', '-j', default=1, type=int,
+                        help='processes reducing units in parallel, a group each, its reducers split '
+                             'over several when the jobs outnumber the groups, default 1')
+    parser.add_argument('--fft-workers', default=dsp.FFT_WORKERS, type=int,
+                        help=f'threads of each FFT (per job), -1 for one per CPU, default {dsp.FFT_WORKERS}')
+    parser.add_argument('--precision', default='double', choices=list(PRECISIONS),
+                        help='single reduces in complex64, about half the memory and time, default double')
 
     args = parser.parse_args()
-
-    with h5py.File(args.data, 'r') as file:
+    try:
+        dsp.stage_factors(args.decimation)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.jobs > 1 and args.show:
+        LOGGER.warning('--show is ignored with --jobs > 1')
+        args.show = False
+    if not args.show:
+        headless()
+
+    names = []
+    units = []
+    params = {'autocorrelate': {'max_lag': args.max_lag},
+              'differential': {'decimation': args.decimation},
+              'pfb': {'nchan': args.pfb_channels, 'taps': args.pfb_taps},
+              'rfi': {'sk_sigma': args.sk_sigma, 'mad_sigma': args.mad_sigma}}
+    with rawcapture.open_capture(args.data) as file:
         path_stem = args.products / args.data.stem
 
         if not (path_stem.exists() and path_stem.is_dir()):
@@ -428,146 +1143,14 @@ if __name__ == '__main__':
             LOGGER.debug(f'created {path_stem} to stored reduction products')
 
         # write out dataset wide metadata
-        with open(path_stem / 'metadata.txt', 'w') as metadata:
-            for i, (key, val) in enumerate(file.attrs.items()):
-                if i > 0:
-                    metadata.write('\n')
-                metadata.write(f'{key}: {val}')
+        write_metadata(file.attrs, path_stem / 'metadata.txt')
 
         def reduce(option):
-            match option:
-                case 'iq_timeseries':
-                    LOGGER.info('IQ Timeseries Reduction')
-                    if args.n:
-                        # TODO just plot the nth
-                        pass
-                    else:
-                        for i in range(len(file['data'])):
-                            # write metadata for the row
-                            with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                                for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                    if j > 0:
-                                        metadata.write('\n')
-                                    metadata.write(f'{key}: {val}')
-
-                            data = file[f'data/{i}/IQ'][1:]
-                            ref = file[f'data/{i}/reference'][1:]
-                            plot_complex_timeseries(
-                                    data.mean(axis=0),
-                                    ref.mean(axis=0),
-                                    args.show,
-                                    path_stem / f'{i}-{option}')
-
-                case 'magnitude_phase_timeseries':
-                    LOGGER.info('Magnitude Phase Timeseries Reduction')
-                    if args.n:
-                        # TODO just plot the nth
-                        pass
-                    else:
-                        for i in range(len(file['data'])):
-                            # write metadata for the row
-                            with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                                for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                    if j > 0:
-                                        metadata.write('\n')
-                                    metadata.write(f'{key}: {val}')
-
-                            data = file[f'data/{i}/IQ'][1:]
-                            ref = file[f'data/{i}/reference'][1:]
-                            plot_magnitude_phase_timeseries(
-                                    data.mean(axis=0),
-                                    ref.mean(axis=0),
-                                    args.show,
-                                    path_stem / f'{i}-{option}')
-
-                case 'magnitude_histogram':
-                    LOGGER.info('Magnitude Phase Timeseries Reduction')
-                    if args.n:
-                        # plot_magnitude_histogram(data[args.n], args.show, fname)
-                        pass
-                    else:
-                        for i in range(len(file['data'])):
-                            # write metadata for the row
-                            with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                                for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                    if j > 0:
-                                        metadata.write('\n')
-                                    metadata.write(f'{key}: {val}')
-
-                            data = file[f'data/{i}/IQ'][1:]
-                            ref = file[f'data/{i}/reference'][1:]
-                            plot_magnitude_histogram(
-                                    data.mean(axis=0),
-                                    ref.mean(axis=0),
-                                    args.show,
-                                    path_stem / f'{i}-{option}')
-
-                case 'spectrum' | 'spectral':
-                    LOGGER.info('Spectrum Reduction')
-                    if args.n:
-                        # LOGGER.info('integrating 1 row')
-                        # plot_spectrum(data[args.n], meta, show=args.show, fname=fname)
-                        pass
-                    else:
-                        LOGGER.debug('integrating the data set')
-                        for i in range(len(file['data'])):
-                            # write metadata for the row
-                            with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                                for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                    if j > 0:
-                                        metadata.write('\n')
-                                    metadata.write(f'{key}: {val}')
-
-                            group = file[f'data/{i}']
-                            data = group['IQ'][1:]
-                            ref = group['reference'][1:]
-                            spectrum_integration(
-                                    data,
-                                    ref,
-                                    group.attrs,
-                                    show=args.show,
-                                    fname=path_stem / f'{i}-spectral')
-                case 'autocorrelate' | 'acf' | 'ACF' | 'auto':
-                    LOGGER.info('Autocorrelation Function Reduction')
-                    for i in range(len(file['data'])):
-                        # write metadata for the row
-                        with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                            for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                if j > 0:
-                                    metadata.write('\n')
-                                metadata.write(f'{key}: {val}')
-
-                        group = file[f'data/{i}']
-                        data = group['IQ'][1:]
-                        ref = group['reference'][1:]
-                        autocorrelate(
-                                data,
-                                ref,
-                                group.attrs,
-                                show=args.show,
-                                fname=path_stem / f'{i}-ACF')
-
-                case 'differential' | 'diff':
-                    LOGGER.info('Differential Radiometer Reduction')
-                    for i in range(len(file['data'])):
-                        # write metadata for the row
-                        with open(path_stem / f'{i}-metadata.txt', 'w') as metadata:
-                            for j, (key, val) in enumerate(file[f'data/{i}'].attrs.items()):
-                                if j > 0:
-                                    metadata.write('\n')
-                                metadata.write(f'{key}: {val}')
-
-                        group = file[f'data/{i}']
-                        data = group['IQ'][1:]
-                        ref = group['reference'][1:]
-                        differential_radiometer(
-                                data,
-                                ref,
-                                group.attrs,
-                                show=args.show,
-                                fname=path_stem / f'{i}-differential')
-                case _:
-                    LOGGER.info(f'Reducers: {reducers}')
+            name = ALIASES.get(option, option)
+            if name not in REDUCERS:
+                LOGGER.info(f'Reducers: {reducers}')
+            elif name not in names:
+                names.append(name)
 
         for reducer in args.reducer:
             if reducer == 'all':
@@ -603,3 +1186,27 @@ if __name__ == '__main__':
                 '''
             else:
                 reduce(reducer)
+
+        # one unit per group, a single pass over its rows feeds every reducer,
+        # with more jobs than groups the reducers of a group split into units
+        groups = len(file['data'])
+        parts = -(-args.jobs // groups) if groups else 1
+        for i in range(groups):
+            group = file[f'data/{i}']
+            # write metadata for the row
+            write_metadata(group.attrs, path_stem / f'{i}-metadata.txt')
+            rows = None if args.n is None else np.array([args.n])
+            for unit_names in split_reducers(names, parts):
+                units.append((args.data, i, unit_names, args.show, path_stem,
+                              rows, args.max_memory / args.jobs, params, args.precision,
+                              args.fft_workers))
+
+    if args.no_cache:
+        products_cache = nullcontext()
+    else:
+        products_cache = cache.ReductionCache(args.cache or path_stem / 'cache.h5', args.cache_size)
+        products_cache.invalidate(cache.identity(args.data))
+
+    # the file is closed, each unit opens it again
+    with products_cache:
+        reduce_units(units, args.jobs, None if args.no_cache else products_cache)